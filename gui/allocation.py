@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*
+"""
+    Thrust allocation.
+
+    The allocation distributes a required force (Fx, Fy, Mz) between the
+    thrusters of a vessel model. An azimuth thruster contributes two force
+    components (x, y) and a fixed thruster one component along its
+    direction. The weighted least-norm solution is computed and the
+    thrusters exceeding their capacity are clipped to it and removed from
+    the problem, which is solved again for the remaining force until no
+    thruster is saturated.
+
+    Problems are solved by batches: every array has a first dimension over
+    the problems (headings, load magnitudes, batch cases...).
+"""
+import numpy as np
+
+# Project modules
+from vessel import AZIMUTH
+
+
+# Tolerance on the thruster capacities and on the force balance
+CAPACITY_TOL = 1e-9
+BALANCE_TOL = 1e-6
+
+# Maximum number of times the search interval of a limit is doubled
+MAX_EXPANSIONS = 10
+
+# Relative half width of the search interval around a guess of a limit
+GUESS_MARGIN = 0.05
+
+
+class Allocator(object):
+
+    """Allocation matrices of the thrusters of a vessel model, built once
+    and shared by every problem. Failed thrusters are given by index.
+    """
+
+    def __init__(self, model, failed=()):
+        self.n_thrusters = model.n_thrusters
+        self.max_thrust = np.array(model.thruster_max, dtype=float)
+        self.active = np.ones(self.n_thrusters, dtype=bool)
+        self.active[list(failed)] = False
+
+        # One column of the configuration matrix per force component
+        columns = []
+        owner = []
+        for i in range(self.n_thrusters):
+            x, y = model.thruster_x[i], model.thruster_y[i]
+            if model.thruster_type[i] == AZIMUTH:
+                columns.append((1.0, 0.0, -y))
+                columns.append((0.0, 1.0, x))
+                owner.extend((i, i))
+            else:
+                a = model.thruster_angle[i]
+                columns.append((np.cos(a), np.sin(a), x * np.sin(a) - y * np.cos(a)))
+                owner.append(i)
+
+        self.B = np.array(columns).T
+        self.owner = np.array(owner)
+        self.azimuth = np.array(model.thruster_type) == AZIMUTH
+        self.fixed_angle = np.array(model.thruster_angle, dtype=float)
+
+        # Selection matrix summing the squared components of each thruster
+        self.S = np.zeros((len(owner), self.n_thrusters))
+        self.S[np.arange(len(owner)), self.owner] = 1.0
+
+        # Weights of the least-norm solution: the larger thrusters take
+        # the larger share of the load
+        self.weights = self.max_thrust[self.owner] ** 2
+
+        self.symmetric = symmetric_layout(model, self.active)
+
+    def magnitudes(self, forces):
+        """Thrust of each thruster from the (problems, components)
+        forces.
+        """
+        return np.sqrt((forces ** 2).dot(self.S))
+
+    def allocate(self, tau, limit=1.0, active=None):
+        """Allocate the (problems, 3) required forces with the thrusters
+        limited to a fraction of their maximum thrust (scalar or one limit
+        per problem).
+
+        active gives the thrusters in operation, for every problem or as a
+        (problems, thrusters) array, instead of those of the allocator:
+        problems with different failed thrusters share the matrices and
+        are solved together.
+
+        Return a dictionnary of arrays:
+            - forces: (problems, components) allocated force components
+            - thrust: (problems, thrusters) thrust [kN]
+            - azimuth: (problems, thrusters) thrust direction [rad]
+            - utilization: (problems, thrusters) thrust / maximum thrust
+            - feasible: (problems,) True when the forces are balanced
+            - required: (problems,) utilization of the most loaded
+              thruster, estimated without limit when not feasible
+            - saturated: (problems, thrusters) thrusters at their capacity
+        """
+        tau = np.atleast_2d(np.asarray(tau, dtype=float))
+        n = len(tau)
+        limit = np.broadcast_to(np.asarray(limit, dtype=float).reshape(-1, 1), (n, 1))
+        active = np.broadcast_to(
+            self.active if active is None else active, (n, self.n_thrusters)
+            )
+        capacity = np.where(active, self.max_thrust, 0.0) * limit
+
+        free = active & (self.max_thrust > 0) & (capacity > 0)
+        forces = np.zeros((n, len(self.owner)))
+        unconstrained = np.zeros(n)
+        identity = np.eye(3)
+
+        todo = np.arange(n)
+        for it in range(self.n_thrusters + 1):
+            if not len(todo):
+                break
+
+            # Weighted least-norm solution of the remaining force with
+            # the free thrusters
+            d = free[todo][:, self.owner] * self.weights
+            residual = tau[todo] - forces[todo].dot(self.B.T)
+            M = np.einsum('im,km,jm->kij', self.B, d, self.B)
+            M += identity * (1e-12 * np.trace(M, axis1=1, axis2=2)[:, None, None] + 1e-12)
+            lam = np.linalg.solve(M, residual[:, :, None])[:, :, 0]
+            u = forces[todo] + d * lam.dot(self.B)
+
+            mag = self.magnitudes(u)
+            if it == 0:
+                unconstrained[todo] = np.max(mag / self.max_thrust, axis=1)
+            over = free[todo] & (mag > capacity[todo] * (1 + CAPACITY_TOL))
+
+            # Clip the saturated thrusters to their capacity and fix them
+            with np.errstate(divide='ignore', invalid='ignore'):
+                scale = np.where(over, capacity[todo] / mag, 1.0)
+            forces[todo] = u * scale[:, self.owner]
+            free[todo] &= ~over
+
+            todo = todo[over.any(axis=1)]
+
+        residual = tau - forces.dot(self.B.T)
+        feasible = np.all(
+            np.abs(residual) <= BALANCE_TOL * (1.0 + np.abs(tau)), axis=1
+            )
+
+        thrust = self.magnitudes(forces)
+        utilization = thrust / self.max_thrust
+        required = np.where(
+            feasible, np.max(utilization, axis=1), np.maximum(unconstrained, limit[:, 0])
+            )
+
+        return {
+            'forces': forces,
+            'thrust': thrust,
+            'azimuth': self.directions(forces),
+            'utilization': utilization,
+            'feasible': feasible,
+            'required': required,
+            'saturated': (capacity > 0) & ~free,
+            }
+
+    def directions(self, forces):
+        """Thrust direction of each thruster from the force components"""
+        n = len(forces)
+        angles = np.tile(self.fixed_angle, (n, 1))
+        first = np.searchsorted(self.owner, np.arange(self.n_thrusters))
+        az = np.flatnonzero(self.azimuth)
+        angles[:, az] = np.arctan2(forces[:, first[az] + 1], forces[:, first[az]])
+        # Fixed thrusters pushing backward
+        fixed = np.flatnonzero(~self.azimuth)
+        angles[:, fixed] += np.where(forces[:, first[fixed]] < 0, np.pi, 0.0)
+        return np.mod(angles + np.pi, 2 * np.pi) - np.pi
+
+
+def symmetric_layout(model, active, decimals=6):
+    """True when the active thrusters are symmetric about the centreline:
+    each one has a mirror image of the same type and maximum thrust. A
+    fixed thruster pushes both ways, its direction is compared modulo
+    180 deg.
+    """
+    azimuth = np.array(model.thruster_type)[active] == AZIMUTH
+    angle = np.where(
+        azimuth, 0.0, np.mod(np.array(model.thruster_angle)[active], np.pi)
+        )
+    mirror = np.where(azimuth, 0.0, np.mod(-angle, np.pi))
+
+    def rows(y, angle):
+        keys = np.round(np.stack((
+            azimuth, np.array(model.thruster_x)[active], y,
+            # Same direction at both ends of [0, 180 deg)
+            np.sin(2 * angle), np.cos(2 * angle),
+            np.array(model.thruster_max)[active],
+            ), 1), decimals) + 0.0
+        return keys[np.lexsort(keys.T[::-1])]
+
+    y = np.array(model.thruster_y)[active]
+    return np.array_equal(rows(y, angle), rows(-y, mirror))
+
+
+def bisect_limit(is_feasible, upper, tol, n_grid=16, expand=False,
+                 callback=None, guess=None):
+    """Find, for several problems at once, the largest scale s in
+    [0, upper] for which the problem is feasible, assuming the feasible
+    scales form an interval starting at 0. is_feasible(scale, index) takes
+    the scales of the problems of the given indices, one per problem or a
+    (problems, k) grid, and returns the matching boolean array.
+
+    The limits are searched on a lattice of scales: the step of a coarse
+    grid of n_grid steps, halved down to the tolerance. The problems
+    evaluate the grid in one call to bracket their limits. With expand,
+    the upper bound of the problems feasible on the whole grid is doubled
+    until they are not. The limits are then refined by bisection, each
+    step only evaluating the problems which have not converged yet.
+    callback(fraction) is called after each step.
+
+    guess may give an estimate of the limits, e.g. the limits of
+    neighbouring problems: the lattice scales GUESS_MARGIN around it are
+    evaluated first, and the limits they bracket are only refined between
+    them, ending on the same scales as from the grid.
+    """
+    upper = np.asarray(upper, dtype=float)
+    n = len(upper)
+
+    # Lattice step and number of lattice steps per grid step
+    step = upper / n_grid
+    cells = np.ones(n, dtype=np.int64)
+    coarse = step > tol
+    while coarse.any():
+        step[coarse] /= 2
+        cells[coarse] *= 2
+        coarse = step > tol
+
+    # Limits bracketed by lattice indices, lo feasible and hi not
+    last = n_grid * cells
+    if expand:
+        last = last << MAX_EXPANSIONS
+    lo = np.zeros(n, dtype=np.int64)
+    hi = np.zeros(n, dtype=np.int64)
+
+    unseeded = np.arange(n)
+    if guess is not None:
+        guess = np.asarray(guess, dtype=float)
+        valid = step > 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            below = np.where(
+                valid, np.floor((guess * (1 - GUESS_MARGIN) - tol) / step), 0
+                )
+            above = np.where(
+                valid, np.ceil((guess * (1 + GUESS_MARGIN) + tol) / step), 0
+                )
+        below = np.clip(below, 0, last).astype(np.int64)
+        above = np.clip(above, 0, last).astype(np.int64)
+        ok = is_feasible(np.stack((below * step, above * step), 1), unseeded)
+        # Feasible up to the last scale, as on the whole grid
+        top = ok[:, 1] & (above == last)
+        seeded = valid & ((ok[:, 0] & ~ok[:, 1]) | top)
+        lo[seeded] = np.where(top, last, below)[seeded]
+        hi[seeded] = np.where(top, last, above)[seeded]
+        unseeded = np.flatnonzero(~seeded)
+
+    if len(unseeded):
+        index = unseeded
+        grid = upper[index, None] * np.arange(n_grid + 1) / n_grid
+        feasible = is_feasible(grid, index)
+
+        # First infeasible point of the grid
+        first = np.argmin(feasible, axis=1)
+        all_feasible = feasible.all(axis=1)
+        lo[index] = np.where(all_feasible, n_grid, np.maximum(first - 1, 0))
+        hi[index] = np.where(all_feasible, n_grid, first)
+        lo[index] *= cells[index]
+        hi[index] *= cells[index]
+
+        open_ = index[all_feasible] if expand else []
+        for k in range(MAX_EXPANSIONS):
+            if not len(open_):
+                break
+            ok = is_feasible(2 * hi[open_] * step[open_], open_)
+            lo[open_] = np.where(ok, 2 * hi[open_], hi[open_])
+            hi[open_] *= 2
+            open_ = open_[ok]
+
+    active = np.flatnonzero(hi - lo > 1)
+    steps = max(int(np.ceil(np.log2(max(np.max(hi - lo), 1)))), 1)
+    k = 0
+    while len(active):
+        mid = (lo[active] + hi[active]) // 2
+        ok = is_feasible(mid * step[active], active)
+        lo[active] = np.where(ok, mid, lo[active])
+        hi[active] = np.where(ok, hi[active], mid)
+        active = active[hi[active] - lo[active] > 1]
+        k += 1
+        if callback is not None:
+            callback(min(float(k) / steps, 1.0))
+
+    return lo * step
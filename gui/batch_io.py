@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*
+"""
+    Import of sea states tables (scatter diagrams, hindcasts) from files.
+
+    Every supported format is converted, chunk by chunk, into a float64
+    .npy file stored next to the source file. The table is then fed with a
+    memory-map of this file so only the rows displayed or processed are
+    actually read from the disk.
+"""
+import os
+import re
+import tempfile
+import zipfile
+
+import numpy as np
+
+
+# Number of rows converted at once (binary files) and size of the blocks
+# of text read at once (text files)
+CHUNK_ROWS = 100000
+CHUNK_BYTES = 1 << 23
+
+# Alternative names accepted in file headers, in their normalized form
+# (lower case, letters and digits only)
+COLUMN_ALIASES = {
+    'hm0': 'Hs', 'swh': 'Hs',
+    'tpeak': 'Tp',
+    'peakedness': 'Gamma',
+    'dir': 'Heading', 'wavedir': 'Heading', 'mwd': 'Heading',
+    'currvel': 'Curr. vel.', 'currentvel': 'Curr. vel.',
+    'currspeed': 'Curr. vel.', 'currentspeed': 'Curr. vel.',
+    'currdir': 'Curr. Dir.', 'currentdir': 'Curr. Dir.',
+    'windvel': 'Wind Vel.', 'windspeed': 'Wind Vel.', 'ws': 'Wind Vel.',
+    'winddir': 'Wind Dir.', 'wd': 'Wind Dir.',
+    'prob': 'Probability', 'p': 'Probability', 'occurrence': 'Probability',
+    }
+
+
+def _normalize(name):
+    return re.sub(r'[^a-z0-9]', '', name.lower())
+
+
+def parse_table_text(text, delimiter='\t', decimal_comma=True):
+    """Parse table-like text, as copied from a spreadsheet, into a 2-D
+    float array in one go. Columns are separated by tabs (or the given
+    delimiter) and rows by new lines. Decimal commas are accepted unless
+    disabled, a trailing new line is ignored and short rows are padded
+    with empty cells (NaN values).
+
+    Return the array and a dictionnary {(row, column): text} of the cells
+    which are not numbers.
+    """
+
+    text = text.replace('\r\n', '\n').replace('\r', '\n').rstrip('\n')
+    if not text:
+        return np.empty((0, 0)), {}
+
+    if decimal_comma:
+        text = text.replace(',', '.')
+    rows = text.split('\n')
+    widths = [row.count(delimiter) + 1 for row in rows]
+    ncols = max(widths)
+
+    # Pad ragged rows so the cells can be split as a single flat list
+    if min(widths) != ncols:
+        rows = [row + delimiter * (ncols - w) for row, w in zip(rows, widths)]
+    cells = np.array(delimiter.join(rows).split(delimiter))
+    cells = np.char.strip(cells)
+
+    # Empty cells stay NaN values, only the others are converted
+    block = np.full(cells.shape, np.nan)
+    filled = cells != ''
+    invalid = {}
+    try:
+        block[filled] = cells[filled].astype(float)
+
+    except ValueError:
+        # Slow path, only taken when some cells are not numbers
+        for k in np.flatnonzero(filled).tolist():
+            cell = str(cells[k])
+            try:
+                block[k] = float(cell)
+            except ValueError:
+                invalid[divmod(k, ncols)] = cell
+
+    return block.reshape(len(rows), ncols), invalid
+
+
+def map_columns(names, column_headers):
+    """Return, for each column header, the index of the matching name of
+    a file or -1 when the file has no such column.
+    """
+    lookup = dict(
+        (_normalize(header), header) for header in column_headers
+        )
+    lookup.update(
+        (k, v) for k, v in COLUMN_ALIASES.items() if v in column_headers
+        )
+
+    found = {}
+    for i, name in enumerate(names):
+        header = lookup.get(_normalize(name))
+        if header is not None and header not in found:
+            found[header] = i
+
+    return [found.get(header, -1) for header in column_headers]
+
+
+def _converted_path(fname):
+    """Path of the .npy conversion of a file: next to it if possible,
+    otherwise in the temporary directory.
+    """
+    directory, base = os.path.split(os.path.abspath(fname))
+    if not os.access(directory, os.W_OK):
+        directory = tempfile.gettempdir()
+    return os.path.join(directory, base + '.table.npy')
+
+
+def _is_up_to_date(path, fname):
+    return (
+        os.path.exists(path) and
+        os.path.getmtime(path) >= os.path.getmtime(fname)
+        )
+
+
+def _count_lines(fname, bufsize=1 << 24):
+    count = 0
+    last = b'\n'
+    with open(fname, 'rb') as f:
+        buf = f.read(bufsize)
+        while buf:
+            count += buf.count(b'\n')
+            last = buf[-1:]
+            buf = f.read(bufsize)
+    # Last line without new line character
+    if last != b'\n':
+        count += 1
+    return count
+
+
+def _read_text(fname, column_headers, out_path):
+
+    # Sniff the delimiter and the header from the first line
+    with open(fname, 'r') as f:
+        first = f.readline()
+    delimiter = '\t' if '\t' in first else (';' if ';' in first else ',')
+    names = [n.strip().strip('"') for n in first.split(delimiter)]
+
+    try:
+        [float(n.replace(',', '.')) for n in names if n]
+        has_header = False
+        mapping = list(range(len(column_headers)))
+    except ValueError:
+        has_header = True
+        mapping = map_columns(names, column_headers)
+
+    # Upper bound of the number of rows, blank lines are skipped later on
+    nrows = _count_lines(fname) - has_header
+    out = np.lib.format.open_memmap(
+        out_path, mode='w+', dtype=np.float64,
+        shape=(nrows, len(column_headers)),
+        )
+
+    row = 0
+    with open(fname, 'r') as f:
+        if has_header:
+            f.readline()
+        while True:
+            lines = [line for line in f.readlines(CHUNK_BYTES) if line.strip()]
+            if not lines:
+                break
+            # Decimal commas are not possible with the comma separator.
+            # Cells which are not numbers are read as NaN values
+            chunk, _ = parse_table_text(
+                ''.join(lines), delimiter, decimal_comma=delimiter != ','
+                )
+            for j, k in enumerate(mapping):
+                out[row:row + len(chunk), j] = (
+                    chunk[:, k] if 0 <= k < chunk.shape[1] else np.nan
+                    )
+            row += len(chunk)
+
+    out.flush()
+    if row < nrows:
+        _copy_array(out[:row], column_headers, out_path + '.trim.npy')
+        del out
+        os.replace(out_path + '.trim.npy', out_path)
+    else:
+        del out
+
+
+def _copy_array(array, column_headers, out_path):
+    """Copy a 2-D or a structured array, possibly memory-mapped, into a
+    float64 .npy file by chunks of rows.
+    """
+    if array.dtype.names:
+        mapping = map_columns(array.dtype.names, column_headers)
+        columns = [array.dtype.names[k] if k >= 0 else None for k in mapping]
+    else:
+        array = array.reshape(len(array), -1)
+        columns = [
+            j if j < array.shape[1] else None for j in range(len(column_headers))
+            ]
+
+    out = np.lib.format.open_memmap(
+        out_path, mode='w+', dtype=np.float64,
+        shape=(len(array), len(column_headers)),
+        )
+    for start in range(0, len(array), CHUNK_ROWS):
+        chunk = array[start:start + CHUNK_ROWS]
+        for j, col in enumerate(columns):
+            if col is None:
+                out[start:start + len(chunk), j] = np.nan
+            elif array.dtype.names:
+                out[start:start + len(chunk), j] = chunk[col]
+            else:
+                out[start:start + len(chunk), j] = chunk[:, col]
+
+    out.flush()
+    del out
+
+
+def _read_npz(fname, column_headers, out_path):
+    """Read an .npz archive holding either a single 2-D/structured array
+    or one 1-D array per column (named after the column headers). Members
+    are streamed from the archive without being loaded at once.
+    """
+    with zipfile.ZipFile(fname) as archive:
+        members = [n[:-4] for n in archive.namelist() if n.endswith('.npy')]
+        mapping = map_columns(members, column_headers)
+
+        def read_member(name):
+            f = archive.open(name + '.npy')
+            if np.lib.format.read_magic(f) == (1, 0):
+                header = np.lib.format.read_array_header_1_0(f)
+            else:
+                header = np.lib.format.read_array_header_2_0(f)
+            shape, fortran, dtype = header
+            return f, shape, fortran, dtype
+
+        # One array per column
+        if any(k >= 0 for k in mapping):
+            shapes = [
+                read_member(members[k])[1] for k in mapping if k >= 0
+                ]
+            nrows = shapes[0][0]
+            out = np.lib.format.open_memmap(
+                out_path, mode='w+', dtype=np.float64,
+                shape=(nrows, len(column_headers)),
+                )
+            for j, k in enumerate(mapping):
+                if k < 0:
+                    out[:, j] = np.nan
+                    continue
+                f, shape, fortran, dtype = read_member(members[k])
+                for start in range(0, nrows, CHUNK_ROWS):
+                    count = min(CHUNK_ROWS, nrows - start)
+                    buf = f.read(count * dtype.itemsize)
+                    out[start:start + count, j] = np.frombuffer(buf, dtype)
+                f.close()
+            out.flush()
+            del out
+            return
+
+        # A single array
+        if len(members) != 1:
+            raise ValueError('No sea states column found in %s' % fname)
+        f, shape, fortran, dtype = read_member(members[0])
+        if fortran:
+            raise ValueError('Fortran ordered arrays are not supported')
+        nrows = shape[0]
+        ncols = int(np.prod(shape[1:])) if len(shape) > 1 else 1
+        with tempfile.TemporaryFile() as tmp:
+            # Stream the member into a raw file which can then be
+            # memory-mapped and copied as any other array
+            for start in range(0, nrows, CHUNK_ROWS):
+                count = min(CHUNK_ROWS, nrows - start)
+                tmp.write(f.read(count * ncols * dtype.itemsize))
+            f.close()
+            tmp.flush()
+            array = np.memmap(tmp, dtype=dtype, mode='r', shape=shape)
+            _copy_array(array, column_headers, out_path)
+            del array
+
+
+def load_table(fname, column_headers):
+    """Return the sea states of a file as a (rows, columns) float64
+    array memory-mapped in copy-on-write mode, so the table can be edited
+    without modifying the files. Columns are ordered as the column headers
+    and the missing ones are filled with NaN values.
+
+    Supported formats are delimited text files (tab, semicolon or comma,
+    with or without a header line), .npy files (2-D or structured arrays)
+    and .npz archives.
+    """
+    ext = os.path.splitext(fname)[1].lower()
+
+    # A float64 2-D .npy file in the table layout is used as it is
+    if ext == '.npy':
+        array = np.load(fname, mmap_mode='r')
+        if (array.dtype == np.float64 and array.ndim == 2 and
+                array.shape[1] == len(column_headers) and
+                array.flags.c_contiguous):
+            return np.load(fname, mmap_mode='c')
+
+    out_path = _converted_path(fname)
+    if not _is_up_to_date(out_path, fname):
+        # Convert into a temporary file first, so an interrupted
+        # conversion is never mistaken for a valid one
+        tmp_path = out_path + '.tmp.npy'
+        if ext == '.npy':
+            _copy_array(array, column_headers, tmp_path)
+            del array
+        elif ext == '.npz':
+            _read_npz(fname, column_headers, tmp_path)
+        else:
+            _read_text(fname, column_headers, tmp_path)
+        os.replace(tmp_path, out_path)
+
+    return np.load(out_path, mmap_mode='c')
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*
+"""
+    Probability-weighted statistics of the batch results.
+
+    The statistics are updated by the batch form as the results come and
+    only keep fixed size arrays, whatever the number of cases: weighted
+    counts of the infeasible cases, per wave heading sector and per
+    utilization bin.
+"""
+import numpy as np
+
+
+# Wave heading sectors of the operability
+HEADING_SECTOR = 15.0  # [deg]
+
+# Bins of the utilization histogram, the last bin gathers the larger
+# utilizations
+UTILIZATION_BINS = np.linspace(0.0, 2.0, 401)
+
+# Percentiles of the summary
+PERCENTILES = (50, 90, 99)
+
+
+class BatchStatistics(object):
+
+    def __init__(self):
+        n_sectors = int(round(360.0 / HEADING_SECTOR))
+        self.weight = 0.0
+        self.downtime_weight = 0.0
+        self.sector_weight = np.zeros(n_sectors)
+        self.sector_downtime = np.zeros(n_sectors)
+        self.histogram = np.zeros(len(UTILIZATION_BINS) - 1)
+
+    def update(self, weights, headings, utilization, feasible):
+        """Add cases given by arrays of probability weights, wave headings
+        [deg], utilizations and feasibility.
+        """
+        weights = np.asarray(weights, dtype=float)
+        downtime = np.where(np.asarray(feasible, dtype=bool), 0.0, weights)
+        sectors = (
+            np.floor(np.mod(np.nan_to_num(headings), 360.0) / HEADING_SECTOR)
+            .astype(int) % len(self.sector_weight)
+            )
+        bins = np.clip(
+            np.searchsorted(UTILIZATION_BINS, utilization, side='right') - 1,
+            0, len(self.histogram) - 1,
+            )
+
+        self.weight += weights.sum()
+        self.downtime_weight += downtime.sum()
+        self.sector_weight += np.bincount(sectors, weights, len(self.sector_weight))
+        self.sector_downtime += np.bincount(sectors, downtime, len(self.sector_weight))
+        self.histogram += np.bincount(bins, weights, len(self.histogram))
+
+    @property
+    def downtime(self):
+        """Weighted fraction of infeasible cases"""
+        return self.downtime_weight / self.weight if self.weight > 0 else np.nan
+
+    def operability(self):
+        """Weighted fraction of feasible cases of each heading sector, NaN
+        for the sectors without case.
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return 1.0 - self.sector_downtime / self.sector_weight
+
+    def percentile(self, q):
+        """Weighted percentile of the utilization, interpolated in the
+        histogram bins.
+        """
+        if self.weight <= 0:
+            return np.nan
+        cumulative = np.append(0.0, np.cumsum(self.histogram)) / self.weight
+        return float(np.interp(q / 100.0, cumulative, UTILIZATION_BINS))
+
+    def summary(self):
+        return {
+            'weight': self.weight,
+            'downtime': self.downtime,
+            'operability': self.operability(),
+            'percentiles': dict((q, self.percentile(q)) for q in PERCENTILES),
+            }
@@ -1,30 +1,61 @@
 # -*- coding: utf-8 -*
 import sys
 import os
+import time
 import queue
 from functools import partial
 
+import numpy as np
+
 # GUI module
 from PyQt4 import QtCore, QtGui
 
+# Project modules
+from batch_io import load_table, parse_table_text
+from batch_stats import HEADING_SECTOR, BatchStatistics
+from engine import BatchRunner, SharedBatchRunner, group_bounds, unique_cases
+from environment import environmental_loads
+from journal import Journal, case_keys
+from result_store import ResultStore
+from simulation import (
+    applied_load, case_fields, solve_case, solve_loads, utilization_limit,
+    )
+from surrogate import LoadGrid, surrogate_results
+from tablemodel import ArrayTableModel
+from vessel import VesselError, load_vessel
+from widgets.basewidget import BaseWidget
+
 
 COLUMN_HEADERS = (
     'Hs', 'Tp', 'Gamma', 'Heading', 'Curr. vel.', 'Curr. Dir.',
     'Wind Vel.', 'Wind Dir.', 'Probability',
     )
 
+# Columns defining the physical case solved for a row (all but the
+# probability)
+PHYSICAL_COLUMNS = list(range(len(COLUMN_HEADERS) - 1))
+
+# Journal of the solved cases, used to resume the batches
+JOURNAL_PATH = os.path.join(os.path.realpath('..'), 'Results', 'batch.journal')
+
+# Results of the last batch
+RESULTS_DIRECTORY = os.path.join(os.path.realpath('..'), 'Results', 'batch')
+
 
 class Table(QtGui.QDialog):
 
-    """Table widget based on a PyQt.QTableWidget"""
+    """Table widget based on a PyQt.QTableView and an array model"""
 
     def __init__(self, parent=None, column_headers=None, init_rows=10):
         super(Table, self).__init__(parent)
 
-        # Set up a table widget
-        self.table = QtGui.QTableWidget()
+        # Set up a table view on top of an array based model. Only the
+        # visible rows are rendered by the view
         self.column_headers = column_headers
         self.init_row_number = init_rows
+        self.model = ArrayTableModel(column_headers, init_rows)
+        self.table = QtGui.QTableView()
+        self.table.setModel(self.model)
 
         # Layout
         layout = QtGui.QVBoxLayout()
@@ -35,21 +66,11 @@ class Table(QtGui.QDialog):
 
     def initialise(self):
 
-        # Set up the number of rows and columns
-        self.table.setColumnCount(len(self.column_headers))
-        self.table.setRowCount(self.init_row_number)
-
-        # Set up headers
-        for i, col in enumerate(self.column_headers):
-            item = QtGui.QTableWidgetItem()
-            item.setText(col)
-            self.table.setHorizontalHeaderItem(i, item)
-
-        # Set up indexes
-        for i in range(1, 1, 1):
-            item = QtGui.QTableWidgetItem()
-            item.setText(str(i))
-            self.table.setVerticalHeaderItem(i, item)
+        # Fixed row heights so the view does not have to measure every
+        # row of large tables
+        header = self.table.verticalHeader()
+        header.setResizeMode(QtGui.QHeaderView.Fixed)
+        header.setDefaultSectionSize(20)
 
     def keyPressEvent(self, event):
         """Override key press event handler to add the following features:
@@ -57,9 +78,9 @@ class Table(QtGui.QDialog):
             - Delete data
         """
 
-        selected = self.table.selectedRanges()
+        selected = self.table.selectionModel().selection()
 
-        if not selected:
+        if selected.isEmpty():
             return
 
         # Paste data from clipboard
@@ -73,65 +94,55 @@ class Table(QtGui.QDialog):
             if not raw_text:
                 return
 
-            first_row = selected[0].topRow()
-            first_col = selected[0].leftColumn()
-
-            for r, row in enumerate(raw_text.split('\n')):
-                for c, col in enumerate(row.split('\t')):
-                    self.table.setItem(
-                        first_row + r,
-                        first_col + c,
-                        QtGui.QTableWidgetItem(col)
-                        )
+            # Parse the whole block at once and apply it as a single
+            # update, appending rows if necessary
+            block, invalid = parse_table_text(raw_text)
+            self.model.set_block(
+                selected[0].top(), selected[0].left(), block, invalid
+                )
             return
 
         # Enable deleting multiple cells using 'suppr' key
         if event.key() == QtCore.Qt.Key_Delete:
 
-            first_row = selected[0].topRow()
-            last_row = selected[0].bottomRow()
-            first_col = selected[0].leftColumn()
-            last_col = selected[0].rightColumn()
-
-            for r in range(first_row, last_row + 1, 1):
-                for c in range(first_col, last_col + 1, 1):
-                    self.table.setItem(r, c, QtGui.QTableWidgetItem(''))
+            self.model.clear(
+                selected[0].top(),
+                selected[0].left(),
+                selected[0].bottom(),
+                selected[0].right(),
+                )
 
             return
 
     def update_rows(self, nrows):
         """Append or remove rows to the table"""
 
-        # remove last rows
-        while self.table.rowCount() != nrows:
-
-            # Remove last row
-            if self.table.rowCount() > nrows:
-                self.table.removeRow(self.table.rowCount() - 1)
+        self.model.resize(nrows)
 
-            # Append new row
-            elif self.table.rowCount() < nrows:
-                self.table.insertRow(self.table.rowCount())
+    def get_arrays(self, copy=True):
+        """Return the table values as a (rows, columns) float array whose
+        columns follow the column headers, the mask of the cells holding
+        a number and the list of the (row, column) cells which are not
+        numbers. Empty cells are NaN values.
+        """
+        return self.model.get_arrays(copy)
 
     def get_values(self):
         """Return the table values as dictionnary. Keys are the column
         headers.
         """
 
+        values, _, invalid = self.get_arrays()
+
+        if invalid:
+            cells = ', '.join(
+                '%s row %i' % (self.column_headers[c], r + 1) for r, c in invalid
+                )
+            raise ValueError('Table content must be numbers only: %s' % cells)
+
         _values = {}
-        try:
-            for j in range(self.table.columnCount()):
-                rowvals = []
-                for i in range(self.table.rowCount()):
-                    cell = self.table.item(i, j)
-                    if cell:
-                        rowvals.append((i, float(cell.text())))
-                    else:
-                        rowvals.append((i, float('nan')))
-                _values[self.column_headers[j]] = dict(rowvals)
-
-        except ValueError as e:
-            raise ValueError('Table content must be numbers only')
+        for j, header in enumerate(self.column_headers):
+            _values[header] = dict(enumerate(values[:, j].tolist()))
 
         return _values
 
@@ -220,6 +231,39 @@ class BatchInputArea(QtGui.QDialog):
         layout.addWidget(self.ck_fdz_dep, row_widget, 1, 1, 2)
         row_widget +=1
 
+        # Execution options
+        layout.addWidget(QtGui.QLabel('<b>Execution</b>'), row_widget, 0, 1, 3)
+        row_widget +=1
+        self.sp_workers = QtGui.QSpinBox()
+        self.sp_workers.setRange(1, 256)
+        self.sp_workers.setValue(os.cpu_count() or 1)
+        layout.addWidget(QtGui.QLabel('Workers'), row_widget, 0)
+        layout.addWidget(self.sp_workers, row_widget, 1)
+        layout.addWidget(QtGui.QLabel(''), row_widget, 2)
+        row_widget +=1
+        self.sp_chunksize = QtGui.QSpinBox()
+        self.sp_chunksize.setRange(0, 10 ** 6)
+        self.sp_chunksize.setSpecialValueText('auto')
+        self.sp_chunksize.setToolTip('Number of cases sent at once to a worker')
+        layout.addWidget(QtGui.QLabel('Chunk Size'), row_widget, 0)
+        layout.addWidget(self.sp_chunksize, row_widget, 1)
+        layout.addWidget(QtGui.QLabel('[cases]'), row_widget, 2)
+        row_widget +=1
+        self.sp_surrogate = QtGui.QSpinBox()
+        self.sp_surrogate.setRange(0, 200)
+        self.sp_surrogate.setSpecialValueText('off')
+        self.sp_surrogate.setToolTip(
+            'Grid points per load component, the cases are interpolated'
+            )
+        layout.addWidget(QtGui.QLabel('Surrogate Grid'), row_widget, 0)
+        layout.addWidget(self.sp_surrogate, row_widget, 1)
+        layout.addWidget(QtGui.QLabel('[points]'), row_widget, 2)
+        row_widget +=1
+        self.ck_surrogate_resolve = QtGui.QCheckBox('Solve Cases Near Limit')
+        self.ck_surrogate_resolve.setChecked(True)
+        layout.addWidget(self.ck_surrogate_resolve, row_widget, 1, 1, 2)
+        row_widget +=1
+
         # Number of simulations to proceed
         label = QtGui.QLabel('Nb of simulations')
         self.spinBox = QtGui.QSpinBox()
@@ -241,21 +285,35 @@ class BatchFormView(QtGui.QDialog):
         self.table = Table(column_headers=COLUMN_HEADERS)
         self.table.setMinimumSize(QtCore.QSize(600, 0))
         self.start_button = QtGui.QPushButton('START')
+        self.pause_button = QtGui.QPushButton('PAUSE')
+        self.stop_button = QtGui.QPushButton('STOP')
+        self.import_button = QtGui.QPushButton('IMPORT...')
+        self.export_button = QtGui.QPushButton('EXPORT...')
+        self.export_button.setEnabled(False)
         self.progress_bar = QtGui.QProgressBar()
+        self.summary_label = QtGui.QLabel()
 
         # Add the user input area
         self.input_frame = BatchInputArea()
 
+        self.spinBox.setMaximum(10 ** 8)
         self.spinBox.setValue(self.table.init_row_number)
 
         # Define a grid layout
         layout = QtGui.QGridLayout()
+        layout.addWidget(self.import_button, 0, 1)
         layout.addWidget(label, 0, 3)
         layout.addWidget(self.spinBox, 0, 4)
         layout.addWidget(self.table, 1, 1, 1, 4)
         layout.addWidget(self.input_frame, 0, 0, 2, 1)
-        layout.addWidget(self.start_button, 2, 0)
+        buttons = QtGui.QHBoxLayout()
+        buttons.addWidget(self.start_button)
+        buttons.addWidget(self.pause_button)
+        buttons.addWidget(self.stop_button)
+        buttons.addWidget(self.export_button)
+        layout.addLayout(buttons, 2, 0)
         layout.addWidget(self.progress_bar, 2, 1, 1, 4)
+        layout.addWidget(self.summary_label, 3, 0, 1, 5)
 
         # To setup space at the border of the layout
         layout.setMargin(0)
@@ -264,7 +322,7 @@ class BatchFormView(QtGui.QDialog):
 
 
 
-class AppForm(QtGui.QDialog):
+class AppForm(BaseWidget):
 
     def __init__(self, parent=None):
         super(AppForm, self).__init__(parent)
@@ -279,6 +337,12 @@ class AppForm(QtGui.QDialog):
 
         # Connect the spinbox with the table widget to add or remove rows
         self.form.spinBox.valueChanged[int].connect(self.form.table.update_rows)
+        # Keep the spinbox in line when a paste appends rows to the table
+        self.form.table.model.rowsInserted.connect(self._sync_row_count)
+        self.form.table.model.modelReset.connect(self._sync_row_count)
+
+        # Connect the import button to the sea states file dialog
+        self.form.import_button.clicked.connect(self._import_dialog)
 
         # Connect the push button to the open file dialog method
         self.form.input_frame.bt_vessel.clicked.connect(
@@ -286,6 +350,18 @@ class AppForm(QtGui.QDialog):
             )
 
         self.form.start_button.clicked.connect(self.run)
+        self.form.pause_button.clicked.connect(self.pause)
+        self.form.stop_button.clicked.connect(self.stop)
+        self.form.export_button.clicked.connect(self._export_dialog)
+
+        # The batch runs in worker processes (self.job), a timer polls its
+        # progress
+        self.results = None
+        self.surrogate = None
+        self.journal = Journal(JOURNAL_PATH)
+        self.timer = QtCore.QTimer(self)
+        self.timer.setInterval(100)
+        self.timer.timeout.connect(self._poll_runner)
 
         self.set_model()
 
@@ -301,10 +377,14 @@ class AppForm(QtGui.QDialog):
             'rudder_management': 'off',
             'main_propellers_rudder_angle': 0.0,
             'failed_thrusters': '',
-            'use_limitation': 1.0,
+            'use_limitation': 100.0,
             'fdz_dep': False,
             'thrust_loss': True,
             'wave_damp': False,
+            'workers': self.form.input_frame.sp_workers.value(),
+            'chunksize': 0,
+            'surrogate_points': 0,
+            'surrogate_resolve': True,
             }
 
         # Set up the connection between the _param dict and the corresponding
@@ -343,6 +423,21 @@ class AppForm(QtGui.QDialog):
         frame.ck_wavedamp.stateChanged.connect(
             partial(self._update_params_lineedit, 'wave_damp')
             )
+        frame.sp_workers.valueChanged.connect(
+            partial(self._update_params_spinbox, 'workers')
+            )
+        frame.sp_chunksize.valueChanged.connect(
+            partial(self._update_params_spinbox, 'chunksize')
+            )
+        frame.sp_surrogate.valueChanged.connect(
+            partial(self._update_params_spinbox, 'surrogate_points')
+            )
+        frame.ck_surrogate_resolve.stateChanged.connect(
+            partial(self._update_params_checkbox, 'surrogate_resolve')
+            )
+
+    def _sync_row_count(self, *args):
+        self.form.spinBox.setValue(self.form.table.model.rowCount())
 
     def _update_params_lineedit(self, name, double=False):
 
@@ -369,6 +464,10 @@ class AppForm(QtGui.QDialog):
         sender = self.sender()
         self._params[name] = sender.checkState()
 
+    def _update_params_spinbox(self, name):
+        sender = self.sender()
+        self._params[name] = sender.value()
+
     def _file_dialog(self, entry_widget):
         options = {
             'caption': 'Vessel model file',
@@ -376,11 +475,308 @@ class AppForm(QtGui.QDialog):
             'filter': ('YAML file (*.yml)'),
             }
         fname = QtGui.QFileDialog.getOpenFileName(self, **options)
-        if fname:
-            entry_widget.setText(fname.split('/')[-1])
+        if not fname:
+            return
+
+        # The full path is kept, it is the 'vessel' parameter
+        entry_widget.setText(fname)
+
+        # Compile the vessel model once for all the cases and list its
+        # thrusters
+        try:
+            model = load_vessel(fname)
+        except (IOError, OSError, VesselError) as e:
+            QtGui.QMessageBox.warning(self, 'Vessel model', str(e))
+            return
+
+        combobox = self.form.input_frame.cb_failed_thrusters
+        combobox.clear()
+        combobox.addItems(['None'] + model.thruster_names.tolist())
+
+    def _import_dialog(self):
+        options = {
+            'caption': 'Sea states file',
+            'directory': os.path.realpath('..'),
+            'filter': (
+                'Sea states (*.csv *.tsv *.txt *.npy *.npz);;All files (*)'
+                ),
+            }
+        fname = QtGui.QFileDialog.getOpenFileName(self, **options)
+        if not fname:
+            return
+
+        try:
+            array = load_table(fname, COLUMN_HEADERS)
+        except (IOError, ValueError) as e:
+            QtGui.QMessageBox.warning(self, 'Import failed', str(e))
+            return
+
+        self.form.table.model.set_array(array)
+
+    def _export_dialog(self):
+        options = {
+            'caption': 'Export the batch results',
+            'directory': os.path.realpath('..') + '\\Results',
+            'filter': ('CSV file (*.csv)'),
+            }
+        fname = QtGui.QFileDialog.getSaveFileName(self, **options)
+        if not fname:
+            return
+
+        # Cases are numbered by their row in the table
+        self.results.flush()
+        try:
+            self.results.export(fname, self._thruster_names, self._case_numbers)
+        except (IOError, OSError) as e:
+            QtGui.QMessageBox.warning(self, 'Export failed', str(e))
 
     def run(self):
-        print(self._params)
+
+        if self.job is not None and not self.job.done():
+            return
+
+        values, mask, invalid = self.form.table.get_arrays(copy=False)
+        if invalid:
+            QtGui.QMessageBox.warning(
+                self, 'Invalid table', 'Table content must be numbers only'
+                )
+            return
+
+        # Empty rows are skipped
+        self._row_index = np.flatnonzero(mask.any(axis=1))
+        if not len(self._row_index):
+            return
+        rows = values[self._row_index]
+        params = dict(self._params)
+
+        # Cases are weighted by their probability, or equally when no
+        # probability is given
+        self._rows = rows
+        self._weights = np.nan_to_num(rows[:, -1])
+        if np.isnan(rows[:, -1]).all():
+            self._weights = np.ones(len(rows))
+        self.stats = BatchStatistics()
+
+        # Compile the vessel model before the workers share it
+        try:
+            model = load_vessel(params['vessel'])
+        except (IOError, OSError, VesselError) as e:
+            QtGui.QMessageBox.warning(self, 'Vessel model', str(e))
+            return
+
+        # Results are written to memory-mapped files as they come. The
+        # files of the previous batch are released before they are opened
+        # again
+        if self.results is not None:
+            self.results.close()
+        self.results = ResultStore(RESULTS_DIRECTORY, len(rows), model.n_thrusters)
+        self._thruster_names = model.thruster_names.tolist()
+        self._case_numbers = self._row_index + 1
+        self.form.export_button.setEnabled(True)
+
+        # Cases found in the journal are not solved again
+        self._keys = case_keys(rows, params)
+        self.results.write(*self.journal.lookup(self._keys))
+        self._todo = np.flatnonzero(~self.results.solved)
+
+        self._solved = len(rows) - len(self._todo)
+        self.form.progress_bar.setRange(0, len(rows))
+        self.form.progress_bar.setValue(self._solved)
+        self._add_statistics(np.flatnonzero(self.results.solved))
+        if not len(self._todo):
+            return
+
+        # Rows which only differ by their probability are solved once,
+        # the result is then given to every row of the group
+        todo_rows = rows[self._todo]
+        first, self._groups = unique_cases(todo_rows, PHYSICAL_COLUMNS)
+        self._order, self._bounds = group_bounds(self._groups)
+        self._cases = todo_rows[first]
+        self._params_run = params
+
+        # With a surrogate, the grid is solved first and the cases are
+        # interpolated from it
+        self.surrogate = None
+        if self._params['surrogate_points'] > 1:
+            model = load_vessel(params['vessel'])
+            self._loads = environmental_loads(model, self._cases) + applied_load(params)
+            self.surrogate = LoadGrid(self._loads, self._params['surrogate_points'])
+            self._start_runner(solve_loads, self.surrogate.blocks(), params)
+        else:
+            self._start_runner(solve_case, self._cases, params)
+
+        self.form.start_button.setEnabled(False)
+        self.timer.start()
+
+    def _start_runner(self, func, rows, params):
+        options = {
+            'workers': self._params['workers'],
+            'chunksize': self._params['chunksize'] or None,
+            }
+        if func is solve_case:
+            # The cases and their results are exchanged through shared
+            # memory
+            fields = case_fields(load_vessel(params['vessel']))
+            self.job = SharedBatchRunner(func, fields, **options)
+        else:
+            self.job = BatchRunner(func, **options)
+        self.job.start(rows, params)
+
+    def pause(self):
+        if self.job is None or self.job.done():
+            return
+        super(AppForm, self).pause()
+        self.form.pause_button.setText('RESUME' if self.job.paused else 'PAUSE')
+
+    def stop(self):
+        super(AppForm, self).stop()
+        self.form.pause_button.setText('PAUSE')
+
+    def closeEvent(self, event):
+        # Save the cases solved so far before leaving: the running chunks
+        # return after their current case and are collected
+        self.stop()
+        if self.job is not None:
+            while not self.job.done():
+                time.sleep(0.01)
+            if self.surrogate is None:
+                self._poll_runner()
+            self.job.close()
+        self.journal.flush()
+        if self.results is not None:
+            self.results.close()
+        super(AppForm, self).closeEvent(event)
+
+    def _poll_runner(self):
+        """Update the progress bar and gather the results once every case
+        has been solved.
+        """
+        if self.surrogate is not None:
+            self._poll_surrogate()
+            return
+
+        # Store the new results and append them to the journal, a chunk
+        # of cases and the rows of their groups at once
+        stored = []
+        for offset, fields in self.job.collect():
+            stop = offset + len(fields['utilization'])
+            members = self._order[self._bounds[offset]:self._bounds[stop]]
+            indices = self._todo[members]
+            # Indexing copies the fields out of the shared memory, which
+            # is released after the run
+            cases = self._groups[members] - offset
+            fields = dict((name, values[cases]) for name, values in fields.items())
+            self.results.write(indices, fields)
+            self.journal.append(self._keys[indices], fields)
+            stored.append(indices)
+            self._solved += len(indices)
+        stored = np.concatenate(stored) if stored else []
+
+        self.form.progress_bar.setValue(self._solved)
+        self._add_statistics(stored)
+        if not self.job.done():
+            return
+
+        self.timer.stop()
+        self.journal.flush()
+        self.results.flush()
+        self.form.start_button.setEnabled(True)
+        try:
+            # Raise the exception of a failed case, if any
+            self.job.results()
+        except Exception as e:
+            QtGui.QMessageBox.warning(self, 'Batch failed', str(e))
+        self.job.close()
+
+    def _add_statistics(self, indices):
+        """Add the results of the given rows to the batch statistics and
+        show their summary.
+        """
+        if not len(indices):
+            return
+        self.stats.update(
+            self._weights[indices],
+            self._rows[indices, 3],
+            self.results.utilization[indices],
+            self.results.feasible[indices],
+            )
+
+        summary = self.stats.summary()
+        text = 'Downtime: %.2f %%    Utilization: %s' % (
+            100 * summary['downtime'],
+            ', '.join(
+                'P%i %.0f %%' % (q, 100 * value)
+                for q, value in sorted(summary['percentiles'].items())
+                ),
+            )
+
+        # Operability of the wave heading sectors with cases, the worst
+        # one is shown, all of them in the tooltip
+        operability = summary['operability']
+        sectors = np.flatnonzero(~np.isnan(operability))
+        if len(sectors):
+            worst = sectors[np.argmin(operability[sectors])]
+            text += '    Operability: min %.1f %% (waves from %g-%g deg)' % (
+                100 * operability[worst],
+                worst * HEADING_SECTOR, (worst + 1) * HEADING_SECTOR,
+                )
+        self.form.summary_label.setText(text)
+        self.form.summary_label.setToolTip('\n'.join(
+            'Waves from %g-%g deg: %.1f %%' % (
+                k * HEADING_SECTOR, (k + 1) * HEADING_SECTOR,
+                100 * operability[k],
+                )
+            for k in sectors
+            ))
+
+    def _poll_surrogate(self):
+        """Wait for the grid of the surrogate, interpolate the cases, then
+        solve exactly those close to the utilization limit.
+        """
+        if not self.job.done():
+            return
+
+        self.surrogate, grid = None, self.surrogate
+        try:
+            solutions = self.job.results()
+        except Exception as e:
+            solutions = []
+            QtGui.QMessageBox.warning(self, 'Batch failed', str(e))
+        if not solutions or any(s is None for s in solutions):
+            # Stopped or failed before the end of the grid
+            self.timer.stop()
+            self.form.start_button.setEnabled(True)
+            return
+
+        self.job.close()
+
+        required = np.concatenate([s[0] for s in solutions])
+        feasible = np.concatenate([s[1] for s in solutions])
+        fields, exact = surrogate_results(
+            grid, required, feasible, self._loads,
+            utilization_limit(self._params_run),
+            self._params_run.get('surrogate_resolve', True),
+            )
+
+        # Interpolated results are not journaled
+        interpolated = ~exact[self._groups]
+        stored = self._todo[interpolated]
+        cases = self._groups[interpolated]
+        self.results.write(stored, {
+            'utilization': fields['utilization'][cases],
+            'feasible': fields['feasible'][cases],
+            'surrogate': True,
+            })
+        self._solved += len(stored)
+        self.form.progress_bar.setValue(self._solved)
+        self._add_statistics(stored)
+
+        # The cases solved exactly keep their groups, renumbered
+        number = np.cumsum(exact) - 1
+        self._todo = self._todo[~interpolated]
+        self._groups = number[self._groups[~interpolated]]
+        self._order, self._bounds = group_bounds(self._groups)
+        self._start_runner(solve_case, self._cases[exact], self._params_run)
 
 
 if __name__ == '__main__':
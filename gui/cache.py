@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*
+"""
+    Persistent cache of the simulation results.
+
+    Entries are addressed by a hash of the simulation parameters (simulation
+    type included) and of the content of the vessel model file. The cache
+    directory is bounded in size, the least recently used entries being
+    removed first.
+"""
+import os
+import pickle
+import tempfile
+
+# Project modules
+from engine import params_digest
+
+
+class ResultCache(object):
+
+    def __init__(self, directory, max_bytes=256 * 2 ** 20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def key(self, params):
+        return params_digest(params)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.pkl')
+
+    def get(self, key, default=None):
+        """Return the cached value of a key, or default"""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return default
+
+        # The modification time is used as the last access time
+        os.utime(path, None)
+        return value
+
+    def put(self, key, value):
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # Write in a temporary file first so a reader never sees a
+        # partially written entry
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in
+        its maximum size.
+        """
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.pkl'):
+                    stat = os.stat(os.path.join(root, name))
+                    entries.append(
+                        (stat.st_mtime, stat.st_size, os.path.join(root, name))
+                        )
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
@@ -3,11 +3,14 @@ import sys
 import os
 import textwrap
 import queue
+from functools import partial
 
 # GUI modules
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
 
+import numpy as np
+
 # Plotting modules
 import matplotlib
 matplotlib.use('Qt4Agg')
@@ -15,6 +18,28 @@ import matplotlib.pyplot as plt
 from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg
 from matplotlib.backends.backend_qt4agg import NavigationToolbar2QT
 
+# Project modules
+from cache import ResultCache
+from engine import Worker, drain
+from simulation import capability_graph, parse_limits, run_simulation
+from vessel import VesselError, load_vessel
+from widgets.basewidget import BaseWidget
+
+
+SIMULATIONS = (
+    'Thrust Capability Plot', 'Wind Speed CP', 'Current Speed CP',
+    'DNV ERN', 'Dynamic CP (OrcaFlex)',
+    )
+
+# Failure studies, by number of additional failed thrusters
+FAILURE_STUDIES = ('None', 'Single Failures', 'Double Failures')
+
+# Refresh rate of the GUI while a simulation is running
+REFRESH_INTERVAL = 40  # [ms]
+
+# Results of the previous simulations
+CACHE_DIRECTORY = os.path.join(os.path.realpath('..'), 'Results', 'cache')
+
 
 class ValidateEntry(QLineEdit):
     """Custom QLineEdit widget in order to link a dict key, value with
@@ -64,22 +89,25 @@ class InputArea(QWidget):
         layout.addWidget(QLabel('Vessel Model:'), row_widget, 0)
         layout.addWidget(lineedit_vessel, row_widget, 1)
         layout.addWidget(button_vessel, row_widget, 2)
-        button_vessel.clicked.connect(self._file_dialog)
+        button_vessel.clicked.connect(
+            partial(self._file_dialog, lineedit_vessel)
+            )
         row_widget +=1
 
         # Simulation type
         layout.addWidget(QLabel('<b>Simulation</b>'), row_widget, 0, 1, 3)
         row_widget +=1
-        layout.addWidget(QRadioButton('Thrust Capability Plot'), row_widget, 0, 1, 3)
-        row_widget +=1
-        layout.addWidget(QRadioButton('Wind Speed CP'), row_widget, 0, 1, 3)
-        row_widget +=1
-        layout.addWidget(QRadioButton('Current Speed CP'), row_widget, 0, 1, 3)
-        row_widget +=1
-        layout.addWidget(QRadioButton('DNV ERN'), row_widget, 0, 1, 3)
-        row_widget +=1
-        layout.addWidget(QRadioButton('Dynamic CP (OrcaFlex)'), row_widget, 0, 1, 3)
-        row_widget +=1
+        self.simulation_group = QButtonGroup(self)
+        for i, name in enumerate(SIMULATIONS):
+            radio = QRadioButton(name)
+            radio.setChecked(i == 0)
+            self.simulation_group.addButton(radio, i)
+            layout.addWidget(radio, row_widget, 0, 1, 3)
+            row_widget +=1
+        self.params['simulation'] = SIMULATIONS[0]
+        self.simulation_group.buttonClicked[int].connect(
+            self._toggle_simulation
+            )
 
         # Environmental parameters
         layout.addWidget(QLabel('<b>Environment</b>'), row_widget, 0, 1, 3)
@@ -148,27 +176,53 @@ class InputArea(QWidget):
         # Allocator options
         layout.addWidget(QLabel('<b>Allocator Options</b>'), row_widget, 0, 1, 3)
         row_widget +=1
-        combobox_failed_thruster = QComboBox()
+        self.combobox_failed_thruster = QComboBox()
+        self.combobox_failed_thruster.addItem('None')
+        self.params['failed_thrusters'] = ''
+        self.combobox_failed_thruster.currentIndexChanged[int].connect(
+            self._toggle_failed_thruster
+            )
         layout.addWidget(QLabel('Inactive Thrusters'), row_widget, 0)
-        layout.addWidget(combobox_failed_thruster, row_widget, 1)
+        layout.addWidget(self.combobox_failed_thruster, row_widget, 1)
+        layout.addWidget(QLabel(''), row_widget, 2)
+        row_widget +=1
+        # Envelopes of the additional failures, in the same run
+        combobox_failure_study = QComboBox()
+        combobox_failure_study.addItems(FAILURE_STUDIES)
+        self.params['failure_depth'] = 0
+        combobox_failure_study.currentIndexChanged[int].connect(
+            self._toggle_failure_study
+            )
+        layout.addWidget(QLabel('Failure Study'), row_widget, 0)
+        layout.addWidget(combobox_failure_study, row_widget, 1)
         layout.addWidget(QLabel(''), row_widget, 2)
         row_widget +=1
+        # Several limits give one envelope each: 60, 80, 100
         lineedit_use_limit = ValidateEntry(
-            self.params, 'use_limitation', 0.0, float
+            self.params, 'use_limitation', 100.0, parse_limits
             )
-        layout.addWidget(QLabel('Utilization Limit'), row_widget, 0)
+        layout.addWidget(QLabel('Utilization Limits'), row_widget, 0)
         layout.addWidget(lineedit_use_limit, row_widget, 1)
         layout.addWidget(QLabel('[%]'), row_widget, 2)
         row_widget +=1
+        # Only computes half of the headings when the problem is symmetric
         checkbox_symmetrize = QCheckBox('Symmetrize')
+        self.params['symmetrize'] = False
+        checkbox_symmetrize.toggled.connect(self._toggle_symmetrize)
         layout.addWidget(checkbox_symmetrize, row_widget, 0)
-        checkbox_symmetrize = QCheckBox('Thrust Loss')
-        layout.addWidget(checkbox_symmetrize, row_widget, 1, 1, 2)
+        checkbox_thrust_loss = QCheckBox('Thrust Loss')
+        layout.addWidget(checkbox_thrust_loss, row_widget, 1, 1, 2)
         row_widget +=1
-        checkbox_symmetrize = QCheckBox('Wave/Current')
-        layout.addWidget(checkbox_symmetrize, row_widget, 0)
-        checkbox_symmetrize = QCheckBox('Fdz_dependency')
-        layout.addWidget(checkbox_symmetrize, row_widget, 1, 1, 2)
+        checkbox_wave_current = QCheckBox('Wave/Current')
+        layout.addWidget(checkbox_wave_current, row_widget, 0)
+        checkbox_fdz_dependency = QCheckBox('Fdz_dependency')
+        layout.addWidget(checkbox_fdz_dependency, row_widget, 1, 1, 2)
+        row_widget +=1
+        # Refines the headings where the envelope changes quickly
+        checkbox_adaptive = QCheckBox('Adaptive Headings')
+        self.params['adaptive'] = False
+        checkbox_adaptive.toggled.connect(self._toggle_adaptive)
+        layout.addWidget(checkbox_adaptive, row_widget, 0)
         row_widget +=1
 
         # To have no space between widgets
@@ -181,7 +235,39 @@ class InputArea(QWidget):
         self.params[key] = None
 
     def _toggle_vessel_selection(self, fname):
-        pass
+        # Compile the vessel model once for all the simulations and list
+        # its thrusters
+        try:
+            model = load_vessel(fname)
+        except (IOError, OSError, VesselError) as e:
+            QMessageBox.warning(self, 'Vessel model', str(e))
+            return
+
+        self.combobox_failed_thruster.clear()
+        self.combobox_failed_thruster.addItems(
+            ['None'] + model.thruster_names.tolist()
+            )
+
+    def _toggle_failed_thruster(self, index):
+        if index <= 0:
+            self.params['failed_thrusters'] = ''
+        else:
+            self.params['failed_thrusters'] = (
+                self.combobox_failed_thruster.itemText(index)
+                )
+
+    def _toggle_failure_study(self, index):
+        # Number of additional failed thrusters
+        self.params['failure_depth'] = max(index, 0)
+
+    def _toggle_simulation(self, index):
+        self.params['simulation'] = SIMULATIONS[index]
+
+    def _toggle_symmetrize(self, checked):
+        self.params['symmetrize'] = bool(checked)
+
+    def _toggle_adaptive(self, checked):
+        self.params['adaptive'] = bool(checked)
 
     def _toggle_rudder_management(self, event):
         pass
@@ -194,8 +280,9 @@ class InputArea(QWidget):
             }
         fname = QFileDialog.getOpenFileName(self, **options)
         if fname:
-            entry_widget.setText(name.split('/')[-1])
+            entry_widget.setText(fname.split('/')[-1])
             self.params['vessel'] = fname
+            self._toggle_vessel_selection(fname)
 
     def _file_inspect(self):
         if 'vessel' in self.params:
@@ -205,10 +292,10 @@ class InputArea(QWidget):
 
 class MplCanvas(FigureCanvasQTAgg):
 
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, polar=False):
 
         self.fig = plt.Figure()
-        self.axes = self.fig.add_subplot(111)
+        self.axes = self.fig.add_subplot(111, polar=polar)
         super(MplCanvas, self).__init__(self.fig)
         self.setParent(parent)
 
@@ -236,8 +323,8 @@ class GraphArea(QWidget):
 
     def _create_polar_tab(self):
 
-        polar_plot_area = MplCanvas(self)
-        self.notebook.addTab(polar_plot_area, 'Polar Plot')
+        self.polar_plot_area = MplCanvas(self, polar=True)
+        self.notebook.addTab(self.polar_plot_area, 'Polar Plot')
 
     def _create_vector_tab(self):
 
@@ -247,7 +334,23 @@ class GraphArea(QWidget):
     def plot_polar(self, results=None, simu_info=None):
         # simu_info may be no longer necessary. Share a common dict between
         # the differen widgets
-        pass
+        axes = self.polar_plot_area.axes
+        axes.clear()
+
+        # Headings from the bow, positive to portside
+        axes.set_theta_zero_location('N')
+        axes.set_theta_direction(1)
+
+        for result in results or []:
+            # Close the envelope
+            headings = np.radians(np.append(result['headings'], result['headings'][0]))
+            values = np.append(result['values'], result['values'][0])
+            axes.plot(headings, values, label=result['label'])
+
+        if results:
+            axes.set_title('[%s]' % results[0]['unit'])
+            axes.legend(loc='lower right', fontsize='small')
+        self.polar_plot_area.draw()
 
     def plot_vector(self, solutions):
         pass
@@ -276,10 +379,13 @@ class StatusBar(QWidget):
         self.setLayout(layout)
 
     def update_progress(self, value):
-        pass
+        self.progress = value
+        self.progress_bar.setValue(int(round(100 * value)))
+        self.progress_label.setText('%.1f%%' % (100 * value))
 
     def update_status(self, text):
-        pass
+        self.status = text
+        self.status_label.setText(text)
 
 
 class ButtonBar(QWidget):
@@ -289,23 +395,29 @@ class ButtonBar(QWidget):
 
         # Define buttons
         start_button = QPushButton('START')
+        pause_button = QPushButton('PAUSE')
+        stop_button = QPushButton('STOP')
         savefig_button = QPushButton('SAVE FIG')
         export_button = QPushButton('EXPORT TXT')
 
         # Set up the layout
         layout = QHBoxLayout()
         layout.addWidget(start_button)
+        layout.addWidget(pause_button)
+        layout.addWidget(stop_button)
         layout.addWidget(savefig_button)
         layout.addWidget(export_button)
         self.setLayout(layout)
 
         # Bind buttons to the parent methods
         start_button.clicked.connect(parent.run)
+        pause_button.clicked.connect(parent.pause)
+        stop_button.clicked.connect(parent.stop)
         savefig_button.clicked.connect(parent.save_fig)
         export_button.clicked.connect(parent.export)
 
 
-class CPForm(QDialog):
+class CPForm(BaseWidget):
 
     _params = {}
 
@@ -313,29 +425,101 @@ class CPForm(QDialog):
         super(CPForm, self).__init__(parent)
 
         # Define sub widgets
-        input_area = InputArea(self)
-        graph_area = GraphArea(self)
-        button_bar = ButtonBar(self)
-        status_bar = StatusBar(self)
+        self.input_area = InputArea(self)
+        self.graph_area = GraphArea(self)
+        self.button_bar = ButtonBar(self)
+        self.status_bar = StatusBar(self)
 
         # Set up the layout
         layout = QGridLayout()
-        layout.addWidget(input_area, 0, 0)
-        layout.addWidget(graph_area, 0, 1)
-        layout.addWidget(button_bar, 1, 0)
-        layout.addWidget(status_bar, 1, 1)
+        layout.addWidget(self.input_area, 0, 0)
+        layout.addWidget(self.graph_area, 0, 1)
+        layout.addWidget(self.button_bar, 1, 0)
+        layout.addWidget(self.status_bar, 1, 1)
 
         self.setLayout(layout)
 
+        # Simulations run in a background worker (self.job) which reports
+        # through a queue
+        self.messages = queue.Queue()
+        self.results = []
+        self.cache = ResultCache(CACHE_DIRECTORY)
+        self._cache_key = None
+        # Stages of the previous runs, only those depending on the
+        # changed parameters are computed again
+        self.evaluation_graph = capability_graph()
+
         # Create a period call using a timer
-        self.periodic_call()
+        self.timer = QTimer(self)
+        self.timer.setInterval(REFRESH_INTERVAL)
+        self.timer.timeout.connect(self.periodic_call)
 
     def periodic_call(self):
-        pass
+        """Process the messages of the worker. Messages are coalesced so
+        the widgets are updated once per call, whatever the number of
+        messages received in between.
+        """
+        progress, status, results, final = drain(self.messages)
+
+        if progress is not None:
+            self.status_bar.update_progress(progress)
+        if status is not None:
+            self.status_bar.update_status(status)
+        # Envelopes are plotted as soon as they are finished
+        self.results.extend(results)
+        if results:
+            self.graph_area.plot_polar(self.results, self._params)
+
+        if final is None:
+            return
+
+        self.timer.stop()
+        kind, value = final
+        if kind == 'error':
+            self.status_bar.update_status(value)
+        elif kind == 'stopped':
+            # The envelopes finished before the stop are kept
+            self.status_bar.update_status('Stopped')
+        else:
+            self.status_bar.update_progress(1.0)
+            self.status_bar.update_status('Done')
+            self.cache.put(self._cache_key, self.results)
 
     def run(self):
-        # TEMPORARY: Display the user input data gathered through the UI
-        print(self._params)
+
+        if self.job is not None and self.job.is_alive():
+            return
+
+        params = dict(self._params)
+
+        # Simulations already computed are taken from the cache
+        self._cache_key = self.cache.key(params)
+        results = self.cache.get(self._cache_key)
+        if results is not None:
+            self.results = results
+            self.status_bar.update_progress(1.0)
+            self.status_bar.update_status('Done (cached)')
+            self.graph_area.plot_polar(self.results, params)
+            return
+
+        self.results = []
+        self.messages = queue.Queue()
+        self.status_bar.update_progress(0.0)
+        self.status_bar.update_status('Running')
+
+        self.job = Worker(
+            partial(run_simulation, graph=self.evaluation_graph),
+            params, self.messages,
+            )
+        self.job.start()
+        self.timer.start()
+
+    def pause(self):
+        super(CPForm, self).pause()
+        if self.job is not None and self.job.is_alive():
+            self.status_bar.update_status(
+                'Paused' if self.job.paused else 'Running'
+                )
 
     def save_fig(self):
         options = {
@@ -0,0 +1,475 @@
+# -*- coding: utf-8 -*
+"""
+    Execution of the simulations outside of the GUI thread.
+
+    This module does not depend on Qt so that it can be imported by the
+    worker processes.
+"""
+import os
+import queue
+import hashlib
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+class Cancelled(Exception):
+    """Raised by Control.checkpoint() when the job has been stopped"""
+
+
+class Control(object):
+
+    """Pause and stop flags of a running job. Jobs call checkpoint()
+    between two steps (heading, case): it blocks while the job is paused
+    and raises Cancelled once it has been stopped. The events may be
+    multiprocessing events so that the flags are shared with worker
+    processes: they are then left as they are, the creator of the events
+    sets the resume event once.
+    """
+
+    def __init__(self, stop_event=None, resume_event=None):
+        self._stop = stop_event or threading.Event()
+        if resume_event is None:
+            resume_event = threading.Event()
+            resume_event.set()
+        self._resume = resume_event
+
+    @property
+    def stopped(self):
+        return self._stop.is_set()
+
+    @property
+    def paused(self):
+        return not self._resume.is_set()
+
+    def pause(self):
+        self._resume.clear()
+
+    def resume(self):
+        self._resume.set()
+
+    def stop(self):
+        self._stop.set()
+        # Release the paused jobs so they can see the stop flag
+        self._resume.set()
+
+    def checkpoint(self):
+        self._resume.wait()
+        if self._stop.is_set():
+            raise Cancelled()
+
+
+# Control of the current worker process, shared with the GUI process
+_control = Control()
+
+
+def _init_worker(stop_event, resume_event):
+    global _control
+    _control = Control(stop_event, resume_event)
+
+
+# Largest default number of rows per chunk: the results of a chunk are
+# only collected once it is done, a crash loses the running chunks
+MAX_CHUNKSIZE = 256
+
+# Parameters which do not change the results of the solved cases
+EXECUTION_PARAMS = (
+    'workers', 'chunksize', 'surrogate_points', 'surrogate_resolve',
+    )
+
+
+def normalize_params(params):
+    """Return the simulation parameters as a sorted tuple of (key, value)
+    pairs, numbers being converted to floats, so two equivalent sets of
+    user inputs ('1', '1.0', 1.0...) compare and hash the same.
+    """
+    items = []
+    for key, value in sorted(params.items()):
+        if key in EXECUTION_PARAMS:
+            continue
+        if not isinstance(value, bool):
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                value = str(value)
+        items.append((key, value))
+    return tuple(items)
+
+
+def file_digest(fname):
+    """Hash of the content of a file, or of its name if it does not
+    exist.
+    """
+    h = hashlib.sha1()
+    if not os.path.isfile(fname):
+        h.update(repr(fname).encode('utf-8'))
+        return h.hexdigest()
+
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def params_digest(params):
+    """Hash of the simulation parameters and of the content of the
+    vessel model file they refer to.
+    """
+    h = hashlib.sha1(repr(normalize_params(params)).encode('utf-8'))
+    h.update(file_digest(params.get('vessel', '')).encode('ascii'))
+    return h.hexdigest()
+
+
+def unique_cases(rows, columns=None, decimals=6):
+    """Group the rows of a (rows, columns) array having the same physical
+    inputs, i.e. the same values in the given columns once rounded to the
+    given number of decimals. Empty (NaN) cells are zeros, as for the
+    solver.
+
+    Return the index of the first row of each group and the group index
+    of every row, so that rows == rows[first][groups] for the compared
+    columns.
+    """
+    keys = rows if columns is None else rows[:, columns]
+    keys = np.round(np.nan_to_num(keys), decimals)
+    # -0.0 and 0.0 must fall in the same group
+    keys += 0.0
+    _, first, groups = np.unique(
+        keys, axis=0, return_index=True, return_inverse=True
+        )
+    return first, groups.ravel()
+
+
+def group_bounds(groups):
+    """Return the row indices sorted by group index and the bounds of the
+    groups in them: the rows of the groups a to b - 1 are
+    order[bounds[a]:bounds[b]].
+    """
+    order = np.argsort(groups, kind='stable')
+    bounds = np.append(0, np.cumsum(np.bincount(groups)))
+    return order, bounds
+
+
+def _solve_chunk(func, params, rows):
+    """Solve a chunk of rows in a worker process. A stopped run returns
+    the results of the cases solved so far.
+    """
+    results = []
+    for row in rows:
+        try:
+            _control.checkpoint()
+        except Cancelled:
+            break
+        results.append(func(params, row))
+    return results
+
+
+class BatchRunner(object):
+
+    """Dispatch the rows of a batch to a pool of worker processes, each
+    row being solved by func(params, row), a module level function.
+    Rows are sent by chunks to amortize the inter-process communication
+    and the results are gathered in row order. The run can be paused and
+    stopped between two cases, keeping the cases already solved.
+    """
+
+    def __init__(self, func, workers=None, chunksize=None):
+        self.func = func
+        self.workers = workers or os.cpu_count() or 1
+        self.chunksize = chunksize
+        # Workers starting after a pause must not resume the run, the
+        # shared resume event is only set here
+        resume = multiprocessing.Event()
+        resume.set()
+        self.control = Control(multiprocessing.Event(), resume)
+        self._executor = None
+        self._futures = []
+        self._offsets = []
+        self._sizes = []
+        self._collected = set()
+
+    def start(self, rows, params):
+        """Submit every row of a (rows, columns) array. Return
+        immediately, use done() and collect() to follow the run.
+        """
+        # By default, several chunks per worker to balance the load
+        chunksize = self.chunksize or min(
+            max(1, len(rows) // (4 * self.workers)), MAX_CHUNKSIZE
+            )
+
+        self._executor = ProcessPoolExecutor(
+            self.workers,
+            initializer=_init_worker,
+            initargs=(self.control._stop, self.control._resume),
+            )
+        self._futures = []
+        self._offsets = []
+        self._sizes = []
+        self._collected = set()
+        for start in range(0, len(rows), chunksize):
+            stop = min(start + chunksize, len(rows))
+            self._futures.append(self._submit(rows, start, stop, params))
+            self._offsets.append(start)
+            self._sizes.append(stop - start)
+
+        # Workers are released once the last chunk is done
+        self._executor.shutdown(wait=False)
+
+    def _submit(self, rows, start, stop, params):
+        return self._executor.submit(
+            _solve_chunk, self.func, params, rows[start:stop]
+            )
+
+    def pause(self):
+        self.control.pause()
+
+    def resume(self):
+        self.control.resume()
+
+    def stop(self):
+        """Stop the run: pending chunks are cancelled and the running ones
+        return after their current case.
+        """
+        for f in self._futures:
+            f.cancel()
+        self.control.stop()
+
+    @property
+    def paused(self):
+        return self.control.paused
+
+    def done(self):
+        return all(f.done() for f in self._futures)
+
+    def collect(self):
+        """Return the (offset of the first row, results) pairs of the
+        chunks completed since the last call. Chunks which raised an
+        exception are left to results().
+        """
+        collected = []
+        for k, f in enumerate(self._futures):
+            if k in self._collected or not f.done():
+                continue
+            self._collected.add(k)
+            if not f.cancelled() and f.exception() is None:
+                collected.append((self._offsets[k], f.result()))
+        return collected
+
+    def results(self):
+        """Return the results in row order, None for the cases which were
+        not solved because the run was stopped. Raise the first exception
+        raised by a case, if any.
+        """
+        results = []
+        for f, size in zip(self._futures, self._sizes):
+            chunk = [] if f.cancelled() else f.result()
+            results.extend(chunk)
+            results.extend([None] * (size - len(chunk)))
+        return results
+
+    def close(self):
+        """Release the worker processes: the pending chunks are cancelled
+        and the running ones are left to finish.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+def _attach(descriptor):
+    """Array of a shared memory block from its (name, dtype, shape)
+    descriptor. Blocks are attached once per process.
+    """
+    name, dtype, shape = descriptor
+    if name not in _attached:
+        # Worker processes share the resource tracker of the process
+        # which created the block, which unlinks it
+        _attached[name] = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, dtype=dtype, buffer=_attached[name].buf)
+
+
+# Shared memory blocks attached by the current process
+_attached = {}
+
+
+def _solve_shared(func, params, inputs, outputs, start, stop):
+    """Solve the rows start to stop of the shared input array and write
+    the results in the shared output arrays. Return the number of cases
+    solved, fewer than the rows if the run is stopped.
+    """
+    rows = _attach(inputs)
+    arrays = dict((name, _attach(d)) for name, d in outputs.items())
+    for i in range(start, stop):
+        try:
+            _control.checkpoint()
+        except Cancelled:
+            return i - start
+        result = func(params, rows[i])
+        for name, array in arrays.items():
+            array[i] = result[name]
+    return stop - start
+
+
+class SharedBatchRunner(BatchRunner):
+
+    """Batch runner exchanging the rows and the results with the worker
+    processes through shared memory: the workers read their rows and
+    write the fields of the results in place, only the chunk bounds and
+    the number of cases solved are sent through the pool.
+
+    outputs gives the (name, dtype, shape) of the fields of the results
+    of func, the shape being that of a single case. collect() then returns
+    the (offset, fields) pairs of the chunks, fields being a dictionnary
+    of arrays over the cases of a chunk, and results() the dictionnary of
+    the whole arrays, NaN for the cases not solved (floats only).
+    """
+
+    def __init__(self, func, outputs, workers=None, chunksize=None):
+        super(SharedBatchRunner, self).__init__(func, workers, chunksize)
+        self.outputs = outputs
+        self._blocks = []
+
+    def _allocate(self, dtype, shape):
+        dtype = np.dtype(dtype)
+        size = max(int(np.prod(shape)) * dtype.itemsize, 1)
+        block = shared_memory.SharedMemory(create=True, size=size)
+        self._blocks.append(block)
+        array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        return (block.name, dtype.str, shape), array
+
+    def start(self, rows, params):
+        self.close()
+        rows = np.asarray(rows)
+        self._inputs, array = self._allocate(rows.dtype, rows.shape)
+        array[:] = rows
+
+        self._descriptors = {}
+        self._arrays = {}
+        for name, dtype, shape in self.outputs:
+            descriptor, array = self._allocate(dtype, (len(rows),) + tuple(shape))
+            if np.issubdtype(array.dtype, np.floating):
+                array[:] = np.nan
+            self._descriptors[name] = descriptor
+            self._arrays[name] = array
+
+        super(SharedBatchRunner, self).start(rows, params)
+
+    def _submit(self, rows, start, stop, params):
+        return self._executor.submit(
+            _solve_shared, self.func, params, self._inputs, self._descriptors,
+            start, stop,
+            )
+
+    def _solved(self, f):
+        if f.done() and not f.cancelled() and f.exception() is None:
+            return f.result()
+        return 0
+
+    def collect(self):
+        collected = []
+        for k, f in enumerate(self._futures):
+            if k in self._collected or not f.done():
+                continue
+            self._collected.add(k)
+            start, count = self._offsets[k], self._solved(f)
+            collected.append((start, dict(
+                (name, array[start:start + count])
+                for name, array in self._arrays.items()
+                )))
+        return collected
+
+    def results(self):
+        for f in self._futures:
+            if not f.cancelled() and f.exception() is not None:
+                raise f.exception()
+        return dict((name, array.copy()) for name, array in self._arrays.items())
+
+    def close(self):
+        """Release the worker processes and the shared memory of the last
+        run, once its results have been read.
+        """
+        super(SharedBatchRunner, self).close()
+        self._arrays = {}
+        for block in self._blocks:
+            try:
+                block.close()
+            except BufferError:
+                # Still viewed by arrays of collect(), the memory is
+                # released with them
+                pass
+            block.unlink()
+        self._blocks = []
+
+
+class Worker(threading.Thread):
+
+    """Run a job in a background thread. The job is called as
+    job(params, messages, control) and reports to the GUI by putting
+    (kind, value) tuples in the messages queue:
+        - ('progress', fraction between 0 and 1)
+        - ('status', text)
+        - ('result', partial result)
+    The worker itself puts ('done', None), ('stopped', None) or
+    ('error', text) at the end.
+    """
+
+    def __init__(self, job, params, messages=None):
+        super(Worker, self).__init__()
+        self.daemon = True
+        self.job = job
+        self.params = params
+        self.messages = messages if messages is not None else queue.Queue()
+        self.control = Control()
+
+    def pause(self):
+        self.control.pause()
+
+    def resume(self):
+        self.control.resume()
+
+    def stop(self):
+        self.control.stop()
+
+    @property
+    def paused(self):
+        return self.control.paused
+
+    def run(self):
+        try:
+            self.job(self.params, self.messages, self.control)
+        except Cancelled:
+            self.messages.put(('stopped', None))
+        except Exception as e:
+            self.messages.put(('error', '%s: %s' % (type(e).__name__, e)))
+        else:
+            self.messages.put(('done', None))
+
+
+def drain(messages):
+    """Get the pending messages of a queue without blocking and coalesce
+    them: return the last progress, the last status, the list of the
+    results and the final ('done', 'stopped' or 'error', value) message or
+    None.
+    """
+    progress = status = final = None
+    results = []
+
+    while True:
+        try:
+            kind, value = messages.get_nowait()
+        except queue.Empty:
+            break
+
+        if kind == 'progress':
+            progress = value
+        elif kind == 'status':
+            status = value
+        elif kind == 'result':
+            results.append(value)
+        else:
+            final = (kind, value)
+
+    return progress, status, results, final
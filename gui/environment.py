@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*
+"""
+    Environmental loads on a vessel model.
+
+    Directions are the directions the wind, the current and the waves come
+    from, relative to the bow and positive to portside. The coefficients
+    of the vessel model give the load on the vessel. Tables given from 0
+    to 180 deg only are mirrored for the other side.
+"""
+import numpy as np
+
+
+# Angular frequencies of the spectral integration of the drift forces,
+# and weights of the trapezoidal integration over them
+OMEGA = np.linspace(0.1, 3.0, 300)  # [rad/s]
+TRAPEZOID = np.diff(OMEGA, prepend=OMEGA[0]) / 2 + np.diff(OMEGA, append=OMEGA[-1]) / 2
+
+# Sign of the (Fx, Fy, Mz) components on the mirrored side
+MIRROR_SIGNS = np.array([1.0, -1.0, -1.0])
+
+# Maximum number of (Tp, Gamma) pairs of drift integrals kept in memory
+DRIFT_CACHE_SIZE = 100000
+
+# Drift coefficients at the integration frequencies, and drift integrals
+# per (Tp, Gamma) pair, of the current process
+_frequency_coefs = {}
+_drift_integrals = {}
+
+
+class HeadingTable(object):
+
+    """Linear interpolant of (3, headings) coefficient tables over
+    relative directions, built once per table. Tables given from 0 to
+    180 deg only are mirrored for the other side. Calling it with an
+    array of directions [rad] returns the coefficients with a last
+    dimension of 3.
+    """
+
+    def __init__(self, headings, coefs):
+        self.headings = np.array(headings, dtype=float)
+        self.coefs = np.array(coefs, dtype=float)
+        self.mirrored = self.headings[-1] <= np.pi + 1e-9
+
+    def __call__(self, directions):
+        directions = np.mod(np.asarray(directions, dtype=float), 2 * np.pi)
+
+        # Table over the whole circle
+        if not self.mirrored:
+            return np.stack([
+                np.interp(directions, self.headings, c, period=2 * np.pi)
+                for c in self.coefs
+                ], axis=-1)
+
+        other_side = directions > np.pi
+        directions = np.where(other_side, 2 * np.pi - directions, directions)
+        signs = np.where(other_side[..., None], MIRROR_SIGNS, 1.0)
+        return signs * np.stack([
+            np.interp(directions, self.headings, c) for c in self.coefs
+            ], axis=-1)
+
+
+def _table_symmetric(table, decimals=6):
+    """True when a HeadingTable gives mirrored loads on both sides of the
+    vessel.
+    """
+    if table.mirrored:
+        # Mirrored by construction
+        return True
+    load = table(table.headings)
+    mirrored = MIRROR_SIGNS * table(-table.headings)
+    scale = np.max(np.abs(load)) or 1.0
+    return np.allclose(load, mirrored, atol=scale * 10.0 ** -decimals)
+
+
+def tables_symmetric(model):
+    """True when every load table of a vessel model is port/starboard
+    symmetric.
+    """
+    return (
+        _table_symmetric(model.wind_table) and
+        _table_symmetric(model.current_table) and
+        all(
+            _table_symmetric(
+                HeadingTable(model.drift_headings, model.drift_coefs[:, :, j])
+                )
+            for j in range(len(model.drift_periods))
+            )
+        )
+
+
+def wind_load(model, speed, direction):
+    """Wind load of speeds and directions [deg] broadcasting together.
+    Return the loads with a last dimension of 3.
+    """
+    speed = np.asarray(speed, dtype=float)
+    return speed[..., None] ** 2 * model.wind_table(np.radians(direction))
+
+
+def current_load(model, speed, direction):
+    """Current load, see wind_load()"""
+    speed = np.asarray(speed, dtype=float)
+    return speed[..., None] ** 2 * model.current_table(np.radians(direction))
+
+
+def table_weights(headings, directions):
+    """Interpolation of (3, headings) coefficient tables at relative
+    directions [rad]: return the (directions, headings) weights and the
+    (directions, 3) signs such that the coefficients are
+    signs * weights.dot(coefs.T).
+    """
+    directions = np.mod(np.atleast_1d(np.asarray(directions, dtype=float)), 2 * np.pi)
+    signs = np.ones((len(directions), 3))
+    identity = np.eye(len(headings))
+
+    # Table over the whole circle
+    if headings[-1] > np.pi + 1e-9:
+        weights = np.array([
+            np.interp(directions, headings, identity[j], period=2 * np.pi)
+            for j in range(len(headings))
+            ]).T
+        return weights, signs
+
+    mirrored = directions > np.pi
+    directions = np.where(mirrored, 2 * np.pi - directions, directions)
+    signs[mirrored] = MIRROR_SIGNS
+    weights = np.array([
+        np.interp(directions, headings, identity[j]) for j in range(len(headings))
+        ]).T
+    return weights, signs
+
+
+def jonswap(omega, hs, tp, gamma):
+    """JONSWAP wave spectrum [m^2.s/rad]. A peak enhancement factor lower
+    than 1 (or undefined) gives a Pierson-Moskowitz spectrum. The
+    parameters may be arrays broadcasting with omega.
+    """
+    gamma = np.where(np.asarray(gamma) >= 1.0, gamma, 1.0)
+    wp = 2 * np.pi / np.asarray(tp, dtype=float)
+    sigma = np.where(omega <= wp, 0.07, 0.09)
+    a_gamma = 1 - 0.287 * np.log(gamma)
+    return (
+        a_gamma * 5.0 / 16.0 * hs ** 2 * wp ** 4 * omega ** -5 *
+        np.exp(-1.25 * (omega / wp) ** -4) *
+        gamma ** np.exp(-0.5 * ((omega - wp) / (sigma * wp)) ** 2)
+        )
+
+
+def _drift_frequency_coefs(model):
+    """(3, headings, frequencies) drift coefficients of a vessel model at
+    the frequencies of the spectral integration.
+    """
+    key = (model.path, model.sha1)
+    if key not in _frequency_coefs:
+        periods = 2 * np.pi / OMEGA
+        _frequency_coefs[key] = np.array([
+            [np.interp(periods, model.drift_periods, c) for c in coefs]
+            for coefs in model.drift_coefs
+            ])
+    return _frequency_coefs[key]
+
+
+def drift_integrals(model, tp, gamma):
+    """(pairs, 3, headings) drift loads [kN/m^2] of the table headings of
+    a vessel model, for a unit significant wave height and each (Tp,
+    Gamma) pair. The drift load of any direction is interpolated from
+    them, and scales with Hs^2.
+
+    The integrals are computed once per pair and kept for the next calls
+    of the process.
+    """
+    tp = np.atleast_1d(np.asarray(tp, dtype=float))
+    gamma = np.atleast_1d(np.asarray(gamma, dtype=float))
+    model_key = (model.path, model.sha1)
+
+    # The cache is only looked up for the distinct pairs, sorted as
+    # complex numbers which is much faster than as rows
+    pairs, inverse = np.unique(tp + 1j * gamma, return_inverse=True)
+    tp, gamma = pairs.real, pairs.imag
+    keys = [(model_key, t, g) for t, g in zip(tp.tolist(), gamma.tolist())]
+    missing = [k for k, key in enumerate(keys) if key not in _drift_integrals]
+    if missing:
+        if len(_drift_integrals) + len(missing) > DRIFT_CACHE_SIZE:
+            _drift_integrals.clear()
+            missing = list(range(len(keys)))
+        spectra = jonswap(OMEGA, 1.0, tp[missing, None], gamma[missing, None])
+        # Trapezoidal integration as a product with the spectra
+        integrals = 2 * np.einsum(
+            'khw,pw->pkh', _drift_frequency_coefs(model), spectra * TRAPEZOID
+            )
+        for k, integral in zip(missing, integrals):
+            _drift_integrals[keys[k]] = integral
+
+    return np.array([_drift_integrals[key] for key in keys])[inverse.reshape(-1)]
+
+
+def drift_loads(model, hs, tp, gamma, direction):
+    """Mean wave drift loads of arrays of sea states: the drift
+    coefficients [kN/m^2] integrated against the wave spectra. Return the
+    (sea states, 3) loads.
+    """
+    hs, tp, gamma, direction = np.broadcast_arrays(
+        *(np.atleast_1d(np.asarray(v, dtype=float)) for v in (hs, tp, gamma, direction))
+        )
+    loads = np.zeros((len(hs), 3))
+    valid = np.flatnonzero((hs > 0) & (tp > 0))
+    if not len(valid):
+        return loads
+
+    # One integration per (Tp, Gamma) pair
+    gamma = np.where(gamma >= 1.0, gamma, 1.0)
+    integrals = drift_integrals(model, tp[valid], gamma[valid])
+
+    weights, signs = table_weights(model.drift_headings, np.radians(direction[valid]))
+    loads[valid] = (
+        hs[valid, None] ** 2 * signs * np.einsum('rkh,rh->rk', integrals, weights)
+        )
+    return loads
+
+
+def environmental_loads(model, rows):
+    """Total (Fx, Fy, Mz) environmental loads of a (rows, 8) array of
+    cases: Hs, Tp, Gamma, wave direction, current velocity and direction,
+    wind velocity and direction. Undefined (NaN) values are considered as
+    null. Return the (rows, 3) loads.
+    """
+    rows = np.nan_to_num(np.atleast_2d(np.asarray(rows, dtype=float))[:, :8])
+    hs, tp, gamma, wave_dir, curr_vel, curr_dir, wind_vel, wind_dir = rows.T
+    return (
+        drift_loads(model, hs, tp, gamma, wave_dir) +
+        current_load(model, curr_vel, curr_dir) +
+        wind_load(model, wind_vel, wind_dir)
+        )
+
+
+def environmental_load(model, hs, tp, gamma, wave_dir, curr_vel, curr_dir,
+                       wind_vel, wind_dir):
+    """Total (Fx, Fy, Mz) environmental load of a case, see
+    environmental_loads().
+    """
+    return environmental_loads(model, [
+        hs, tp, gamma, wave_dir, curr_vel, curr_dir, wind_vel, wind_dir,
+        ])[0]
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*
+"""
+    Incremental evaluation of the stages of a simulation.
+
+    A stage is computed from some user parameters and from other stages.
+    Its value is kept and only computed again when one of its parameters,
+    or one of the stages it depends on, has changed since the previous
+    evaluation: tweaking a parameter only recomputes the stages downstream
+    of it.
+"""
+# Project modules
+from engine import normalize_params
+
+
+class EvaluationGraph(object):
+
+    def __init__(self):
+        self._stages = {}
+        # Signature, version and value of each stage
+        self._cache = {}
+
+    def add(self, name, keys, depends, func, signature=None):
+        """Add a stage computed as func(params, *values of depends) from
+        the parameters of the given keys. signature(params) may give the
+        signature of the parameters instead, e.g. to include the content
+        of a file.
+        """
+        self._stages[name] = (tuple(keys), tuple(depends), func, signature)
+
+    def evaluate(self, params, *names):
+        """Values of stages for the given parameters, computing them and
+        the stages they depend on if necessary. Return the value of a
+        single stage, or the list of the values.
+        """
+        versions = {}
+        values = [self._evaluate(params, name, versions) for name in names]
+        return values[0] if len(names) == 1 else values
+
+    def _evaluate(self, params, name, versions):
+        keys, depends, func, signature = self._stages[name]
+
+        values = [self._evaluate(params, d, versions) for d in depends]
+        if signature is None:
+            own = normalize_params(dict((k, params.get(k)) for k in keys))
+        else:
+            own = signature(params)
+        key = (own, tuple(versions[d] for d in depends))
+
+        cached = self._cache.get(name)
+        if cached is not None and cached[0] == key:
+            versions[name] = cached[1]
+            return cached[2]
+
+        value = func(params, *values)
+        version = cached[1] + 1 if cached is not None else 0
+        self._cache[name] = (key, version, value)
+        versions[name] = version
+        return value
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*
+"""
+    Append-only journal of the batch results, used to resume a batch
+    which has been stopped or has crashed.
+
+    Each case is identified by a hash of its table row, of the simulation
+    parameters and of the content of the vessel model file. The results
+    are buffered and appended to the journal file by chunks. The journal
+    keeps the cases of the previous batches up to a number of records.
+"""
+import os
+import time
+import pickle
+import hashlib
+
+import numpy as np
+
+# Project modules
+from engine import params_digest
+
+
+# Seconds between two writes of the journal
+FLUSH_INTERVAL = 5.0
+
+# Records kept by the journal, about 200 bytes each
+MAX_RECORDS = 2000000
+
+
+def case_keys(rows, params):
+    """Return the keys of the cases of a (rows, columns) array solved
+    with the given parameters, as an array of digests.
+    """
+    prefix = hashlib.sha1(params_digest(params).encode('ascii'))
+
+    rows = np.ascontiguousarray(rows, dtype=np.float64)
+    keys = np.empty(len(rows), dtype='S%i' % prefix.digest_size)
+    for i, row in enumerate(rows):
+        h = prefix.copy()
+        h.update(row.tobytes())
+        keys[i] = h.digest()
+    return keys
+
+
+class Journal(object):
+
+    """Journal file of the results of cases. The results are appended by
+    chunks, as arrays of keys and dictionnaries of arrays of the fields
+    of the results, and the chunks are pickled at most every
+    flush_interval seconds: the results of the last interval are lost in
+    case of a crash.
+    """
+
+    def __init__(self, fname, flush_interval=FLUSH_INTERVAL):
+        self.fname = fname
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._last_flush = time.time()
+
+    def _chunks(self):
+        """Iterate the (keys, fields) chunks of the journal. A chunk
+        truncated by a crash is discarded.
+        """
+        if not os.path.exists(self.fname):
+            return
+
+        with open(self.fname, 'rb') as f:
+            valid = 0
+            while True:
+                try:
+                    chunk = pickle.load(f)
+                except (EOFError, pickle.UnpicklingError, ValueError):
+                    break
+                valid = f.tell()
+                yield chunk
+
+        # Drop the corrupted tail so that new records can be appended
+        if valid < os.path.getsize(self.fname):
+            with open(self.fname, 'r+b') as f:
+                f.truncate(valid)
+
+    def lookup(self, keys):
+        """Return the indices of the given keys found in the journal and
+        the dictionnary of the arrays of their results. Only the results
+        of these keys are loaded.
+
+        The journal is then compacted: results written twice are dropped,
+        and so are the oldest results of other batches beyond
+        MAX_RECORDS, the results of the given keys being always kept.
+        """
+        self.flush()
+        keys = np.asarray(keys)
+        wanted = np.unique(keys)
+
+        found = []
+        journaled = []
+        for chunk_keys, fields in self._chunks():
+            journaled.append(chunk_keys)
+            mask = np.isin(chunk_keys, wanted)
+            if mask.any():
+                found.append((
+                    chunk_keys[mask],
+                    dict((name, values[mask]) for name, values in fields.items()),
+                    ))
+        if journaled:
+            self._compact(np.concatenate(journaled), wanted)
+        if not found:
+            return np.zeros(0, dtype=int), {}
+
+        # The last result of a key is kept
+        found_keys = np.concatenate([k for k, f in found])
+        names = found[0][1].keys()
+        fields = dict(
+            (name, np.concatenate([f[name] for k, f in found])) for name in names
+            )
+        last = len(found_keys) - 1 - np.unique(found_keys[::-1], return_index=True)[1]
+        found_keys = found_keys[last]
+        fields = dict((name, values[last]) for name, values in fields.items())
+
+        position = np.minimum(np.searchsorted(found_keys, keys), len(found_keys) - 1)
+        index = np.flatnonzero(found_keys[position] == keys)
+        return index, dict(
+            (name, values[position[index]]) for name, values in fields.items()
+            )
+
+    def _compact(self, journaled, wanted):
+        """Rewrite the journal without the records written twice and the
+        oldest records beyond MAX_RECORDS which are not wanted. journaled
+        are the keys of every record, in the order of the journal.
+        """
+        n = len(journaled)
+        keep = np.zeros(n, dtype=bool)
+        keep[n - 1 - np.unique(journaled[::-1], return_index=True)[1]] = True
+
+        excess = np.count_nonzero(keep) - MAX_RECORDS
+        if excess > 0:
+            others = np.flatnonzero(keep & ~np.isin(journaled, wanted))
+            keep[others[:excess]] = False
+        if keep.all():
+            return
+
+        # The kept records are copied chunk by chunk
+        temporary = self.fname + '.tmp'
+        with open(temporary, 'wb') as f:
+            start = 0
+            for chunk_keys, fields in self._chunks():
+                mask = keep[start:start + len(chunk_keys)]
+                start += len(chunk_keys)
+                if mask.any():
+                    pickle.dump((
+                        chunk_keys[mask],
+                        dict((name, values[mask]) for name, values in fields.items()),
+                        ), f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.fname)
+
+    def append(self, keys, fields):
+        """Append the results of the cases of an array of keys, given as
+        a dictionnary of arrays over the cases.
+        """
+        if len(keys):
+            self._buffer.append((np.asarray(keys), fields))
+        if time.time() - self._last_flush > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.time()
+        if not self._buffer:
+            return
+
+        directory = os.path.dirname(self.fname)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # The buffered chunks are written as a single one
+        keys = np.concatenate([k for k, f in self._buffer])
+        fields = dict(
+            (name, np.concatenate([f[name] for k, f in self._buffer]))
+            for name in self._buffer[0][1]
+            )
+        with open(self.fname, 'ab') as f:
+            pickle.dump((keys, fields), f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        self._buffer = []
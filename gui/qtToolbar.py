@@ -132,10 +132,14 @@ class ToolBarDemo(QMainWindow):
         self._widgets.setCurrentIndex(widget_id)
 
     def cbk_run(self):
-        print('Ruuuuuuunnnn')
+        widget = self._widgets.currentWidget()
+        if hasattr(widget, 'run'):
+            widget.run()
 
     def cbk_stop(self):
-        print('STOP !!')
+        widget = self._widgets.currentWidget()
+        if hasattr(widget, 'stop'):
+            widget.stop()
 
 
 class App(QMainWindow):
@@ -6,6 +6,9 @@ import sys
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
 
+from batch_io import parse_table_text
+from tablemodel import ArrayTableModel
+
 
 class Table(QWidget):
 
@@ -18,8 +21,10 @@ class Table(QWidget):
     def __init__(self, parent=None):
         super(Table, self).__init__(parent)
 
-        # Set up a table widget
-        self.table = QTableWidget()
+        # Set up a table view on top of an array based model
+        self.model = ArrayTableModel(self.column_headers, self.init_row_number)
+        self.table = QTableView()
+        self.table.setModel(self.model)
 
         # Layout
         layout = QVBoxLayout()
@@ -30,21 +35,11 @@ class Table(QWidget):
 
     def initialise(self):
 
-        # Set up the number of rows and columns
-        self.table.setColumnCount(len(self.column_headers))
-        self.table.setRowCount(self.init_row_number)
-
-        # Set up headers
-        for i, col in enumerate(self.column_headers):
-            item = QTableWidgetItem()
-            item.setText(col)
-            self.table.setHorizontalHeaderItem(i, item)
-
-        # Set up indexes
-        for i in range(1, 1, 1):
-            item = QTableWidgetItem()
-            item.setText(str(i))
-            self.table.setVerticalHeaderItem(i, item)
+        # Fixed row heights so the view does not have to measure every
+        # row of large tables
+        header = self.table.verticalHeader()
+        header.setResizeMode(QHeaderView.Fixed)
+        header.setDefaultSectionSize(20)
 
 
     def keyPressEvent(self, event):
@@ -53,9 +48,9 @@ class Table(QWidget):
             - Delete data using supp. key
         """
 
-        selected = self.table.selectedRanges()
+        selected = self.table.selectionModel().selection()
 
-        if not selected:
+        if selected.isEmpty():
             return
 
         # Paste data from clipboard
@@ -69,64 +64,56 @@ class Table(QWidget):
             if not raw_text:
                 return
 
-            first_row = selected[0].topRow()
-            first_col = selected[0].leftColumn()
-
-            for r, row in enumerate(raw_text.split('\n')):
-                for c, col in enumerate(row.split('\t')):
-                    self.table.setItem(
-                        first_row + r,
-                        first_col + c,
-                        QTableWidgetItem(col)
-                        )
+            # Parse the whole block at once and apply it as a single
+            # update, appending rows if necessary
+            block, invalid = parse_table_text(raw_text)
+            self.model.set_block(
+                selected[0].top(), selected[0].left(), block, invalid
+                )
             return
 
         # Enable deleting multiple cells using 'suppr' key
         if event.key() == Qt.Key_Delete:
 
-            # Figure out boudaries of the selected data to delete
-            first_row = selected[0].topRow()
-            last_row = selected[0].bottomRow()
-            first_col = selected[0].leftColumn()
-            last_col = selected[0].rightColumn()
-
-            # Set null value ('') in each cells of the selected range
-            for r in range(first_row, last_row + 1, 1):
-                for c in range(first_col, last_col + 1, 1):
-                    self.table.setItem(r, c, QTableWidgetItem(''))
+            # Set NaN values in the selected range
+            self.model.clear(
+                selected[0].top(),
+                selected[0].left(),
+                selected[0].bottom(),
+                selected[0].right(),
+                )
             return
 
     def update_rows(self, nrows):
         """Append or remove rows to the table based on a given number of
         rows.
         """
-        while self.table.rowCount() != nrows:
-            # Remove last row
-            if self.table.rowCount() > nrows:
-                self.table.removeRow(self.table.rowCount() - 1)
-            # Append new row
-            elif self.table.rowCount() < nrows:
-                self.table.insertRow(self.table.rowCount())
+        self.model.resize(nrows)
+
+    def get_arrays(self, copy=True):
+        """Return the table values as a (rows, columns) float array whose
+        columns follow the column headers, the mask of the cells holding
+        a number and the list of the (row, column) cells which are not
+        numbers. Empty cells are NaN values.
+        """
+        return self.model.get_arrays(copy)
 
     def get_values(self):
         """Return values of the table as dictionnary. Empty cells are
         considered as NaN values.
         """
 
-        _values = {}
+        values, _, invalid = self.get_arrays()
 
-        for j in range(self.table.columnCount()):
-            rowvals = []
-            for i in range(self.table.rowCount()):
-                cell = self.table.item(i, j)
-                if cell:
-                    try:
-                        rowvals.append((i, float(cell.text())))
-                    except ValueError as e:
-                        raise ValueError('Table content must be numbers only')
-                else:
-                    rowvals.append((i, float('nan')))
-                _values[self.column_headers[j]] = dict(rowvals)
+        if invalid:
+            cells = ', '.join(
+                '%s row %i' % (self.column_headers[c], r + 1) for r, c in invalid
+                )
+            raise ValueError('Table content must be numbers only: %s' % cells)
+
+        _values = {}
+        for j, header in enumerate(self.column_headers):
+            _values[header] = dict(enumerate(values[:, j].tolist()))
 
         return _values
 
@@ -144,6 +131,7 @@ class Form(QDialog):
         self.table = Table()
         button = QPushButton('Values')
 
+        spinBox.setMaximum(10 ** 8)
         spinBox.setValue(self.table.init_row_number)
 
         # Define a grid layout
@@ -157,6 +145,9 @@ class Form(QDialog):
 
         # Connect the spinbox with the table widget to add or remove rows
         spinBox.valueChanged[int].connect(self.table.update_rows)
+        self.table.model.rowsInserted.connect(
+            lambda *args: spinBox.setValue(self.table.model.rowCount())
+            )
 
         # Connect button to display table content
         button.clicked.connect(self.display_table_content)
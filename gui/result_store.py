@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*
+"""
+    Columnar store of the batch results.
+
+    Each field of the results is a fixed-dtype array saved in its own .npy
+    file and memory-mapped: results are written by chunks of cases as they
+    come, and read by field without loading the whole batch in memory.
+    Fields of the thrusters have one column per thruster.
+"""
+import os
+
+import numpy as np
+
+
+# Fields of the results, with their dtype and whether they have a column
+# per thruster
+FIELDS = (
+    ('solved', bool, False),
+    ('surrogate', bool, False),
+    ('feasible', bool, False),
+    ('utilization', np.float64, False),
+    ('thrust', np.float32, True),
+    ('azimuth', np.float32, True),
+    ('thruster_utilization', np.float32, True),
+    )
+
+# Rows exported at once
+EXPORT_CHUNK = 100000
+
+
+class ResultStore(object):
+
+    """Results of the cases of a batch, stored in a directory. Cases are
+    written by arrays of indices with write() and each field is read as
+    the array attribute of its name, solved telling the cases solved yet.
+
+    The files of a directory are opened by a single store: close() the
+    previous store of a directory before opening a new one.
+    """
+
+    def __init__(self, directory, n_cases, n_thrusters):
+        self.directory = directory
+        self.n_cases = n_cases
+        self.n_thrusters = n_thrusters
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        for name, dtype, per_thruster in FIELDS:
+            shape = (n_cases, n_thrusters) if per_thruster else (n_cases,)
+            array = np.lib.format.open_memmap(
+                os.path.join(directory, name + '.npy'), mode='w+',
+                dtype=dtype, shape=shape,
+                )
+            if np.issubdtype(array.dtype, np.floating):
+                array[:] = np.nan
+            setattr(self, name, array)
+
+    def __len__(self):
+        return self.n_cases
+
+    def write(self, indices, fields):
+        """Write the results of the cases of the given indices. fields is
+        a dictionnary of arrays over these cases, with the names of the
+        fields (a scalar is given to every case). Missing fields are NaN
+        or False.
+        """
+        indices = np.asarray(indices, dtype=int)
+        if not len(indices):
+            return
+        for name, dtype, per_thruster in FIELDS:
+            if name == 'solved':
+                continue
+            default = np.nan if np.issubdtype(np.dtype(dtype), np.floating) else False
+            getattr(self, name)[indices] = fields.get(name, default)
+        self.solved[indices] = True
+
+    def flush(self):
+        for name, dtype, per_thruster in FIELDS:
+            getattr(self, name).flush()
+
+    def close(self):
+        """Write the results to the files and release them"""
+        self.flush()
+        for name, dtype, per_thruster in FIELDS:
+            setattr(self, name, None)
+
+    def export(self, fname, names=None, cases=None):
+        """Write the results to a CSV file, by chunks of cases. names are
+        the names of the thrusters and cases the numbers of the cases, the
+        indices by default.
+        """
+        names = names or ['T%i' % (k + 1) for k in range(self.n_thrusters)]
+        if cases is None:
+            cases = np.arange(self.n_cases)
+        header = ['Case', 'Solved', 'Surrogate', 'Feasible', 'Utilization'] + [
+            '%s %s' % (field, name)
+            for field in ('Thrust', 'Azimuth', 'Utilization') for name in names
+            ]
+        fmt = ['%d', '%d', '%d', '%d', '%.6g'] + ['%.6g'] * (3 * self.n_thrusters)
+
+        with open(fname, 'wb') as f:
+            f.write((','.join(header) + '\n').encode('utf-8'))
+            for start in range(0, self.n_cases, EXPORT_CHUNK):
+                stop = min(start + EXPORT_CHUNK, self.n_cases)
+                columns = np.column_stack((
+                    cases[start:stop], self.solved[start:stop],
+                    self.surrogate[start:stop], self.feasible[start:stop],
+                    self.utilization[start:stop],
+                    self.thrust[start:stop], self.azimuth[start:stop],
+                    self.thruster_utilization[start:stop],
+                    ))
+                np.savetxt(f, columns, fmt=fmt, delimiter=',')
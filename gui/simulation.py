@@ -0,0 +1,565 @@
+# -*- coding: utf-8 -*
+"""
+    Quasi-static simulations: batch cases and capability plots.
+
+    The user parameters are those gathered by the forms (_params). Values
+    typed in line edits are strings, they are converted here.
+"""
+import os
+import itertools
+
+import numpy as np
+
+# Project modules
+from allocation import Allocator, bisect_limit, symmetric_layout
+from evaluation import EvaluationGraph
+from environment import (
+    current_load, drift_loads, environmental_load, tables_symmetric,
+    wind_load,
+    )
+from vessel import load_vessel
+
+
+# Headings of the capability plots
+HEADING_STEP = 5.0  # [deg]
+
+# Adaptive headings: coarse grid, finest step, and tolerance on the
+# interpolated values as a fraction of the maximum value
+COARSE_STEP = 30.0  # [deg]
+MIN_STEP = 0.5  # [deg]
+REFINE_TOL = 0.005
+
+# Headings searched without guess of their limits, the others are
+# guessed from them
+SEED_STRIDE = 4
+
+# Tolerance of the capability searches
+FORCE_TOL = 1.0  # [kN]
+SPEED_TOL = 0.01  # [m/s]
+
+# Speeds searched by the simulations, and first upper bounds of the
+# searches (extended when necessary)
+SPEED_SEARCHES = {'Wind Speed CP': 'wind', 'Current Speed CP': 'current'}
+SPEED_UPPER = {'wind': 40.0, 'current': 3.0}  # [m/s]
+
+# Configurations of a failure study solved together by the bisection
+CONFIGURATION_BATCH = 8
+
+# Headings whose environmental loads are kept by EnvironmentLoads
+ENVIRONMENT_CACHE_SIZE = 64
+
+# Allocators of the current process, by vessel model and failed thrusters
+_allocators = {}
+
+
+def _float(params, key, default=0.0):
+    try:
+        return float(params.get(key))
+    except (TypeError, ValueError):
+        return default
+
+
+def parse_limits(text):
+    """Utilization limits [%] separated by commas, semicolons or spaces"""
+    limits = [
+        float(v) for v in str(text).replace(',', ' ').replace(';', ' ').split()
+        ]
+    if not limits:
+        raise ValueError('No utilization limit')
+    return limits
+
+
+def utilization_limits(params):
+    """Thruster utilization limits as fractions. Undefined or null limits
+    mean 100%.
+    """
+    try:
+        limits = np.array(parse_limits(params.get('use_limitation')))
+    except (TypeError, ValueError):
+        limits = np.zeros(1)
+    return np.where(limits > 0, limits / 100.0, 1.0)
+
+
+def utilization_limit(params):
+    """First thruster utilization limit as a fraction"""
+    return float(utilization_limits(params)[0])
+
+
+def applied_load(params):
+    """(Fx, Fy, Mz) load applied by the pipe"""
+    return np.array([
+        _float(params, 'load_x'), _float(params, 'load_y'), _float(params, 'load_z'),
+        ])
+
+
+def failed_thrusters(params, model):
+    """Indices of the inactive thrusters, given by their names separated
+    by commas.
+    """
+    names = str(params.get('failed_thrusters') or '')
+    return tuple(
+        model.thruster_index(name.strip()) for name in names.split(',')
+        if name.strip() and name.strip() != 'None'
+        )
+
+
+def failure_cases(params, model, allocator):
+    """(label, thrusters in operation) of the configurations of a
+    failure study: the configuration of the parameters (intact unless
+    some thrusters are inactive), then every combination of up to
+    failure_depth more failed thrusters.
+    """
+    depth = int(_float(params, 'failure_depth'))
+    names = model.thruster_names.tolist()
+    failed = [names[i] for i in np.flatnonzero(~allocator.active)]
+
+    cases = [(' + '.join(failed) + ' failed' if failed else 'Intact', allocator.active)]
+    candidates = np.flatnonzero(allocator.active)
+    for k in range(1, depth + 1):
+        for combination in itertools.combinations(candidates, k):
+            active = allocator.active.copy()
+            active[list(combination)] = False
+            label = ' + '.join(failed + [names[i] for i in combination])
+            cases.append((label + ' failed', active))
+    return cases
+
+
+def get_allocator(params):
+    model = load_vessel(params['vessel'])
+    failed = failed_thrusters(params, model)
+    key = (model.path, model.sha1, failed)
+    if key not in _allocators:
+        _allocators[key] = Allocator(model, failed)
+    return _allocators[key]
+
+
+def symmetric_problem(params, model, allocator, configurations=None):
+    """True when the envelope of a capability plot is port/starboard
+    symmetric: symmetric vessel model and thrusters (in every
+    configuration of thrusters in operation, if given), and no transverse
+    applied load.
+    """
+    fx, fy, mz = applied_load(params)
+    if configurations is None:
+        symmetric = allocator.symmetric
+    else:
+        symmetric = all(symmetric_layout(model, a) for a in configurations)
+    return fy == 0.0 and mz == 0.0 and symmetric and tables_symmetric(model)
+
+
+def solve_case(params, row):
+    """Solve the quasi-static case of a batch table row: the thrusters
+    balance the environmental load and the load applied by the pipe.
+    The row columns are Hs, Tp, Gamma, wave heading, current velocity
+    and direction, wind velocity and direction (and probability).
+    """
+    model = load_vessel(params['vessel'])
+    allocator = get_allocator(params)
+
+    load = environmental_load(model, *row[:8]) + applied_load(params)
+    solution = allocator.allocate(-load[None, :], utilization_limit(params))
+
+    return {
+        'utilization': float(solution['required'][0]),
+        'feasible': bool(solution['feasible'][0]),
+        'thrust': solution['thrust'][0],
+        'azimuth': np.degrees(solution['azimuth'][0]),
+        'thruster_utilization': solution['utilization'][0],
+        }
+
+
+def case_fields(model):
+    """(name, dtype, shape) of the fields of the results of solve_case()
+    for a vessel model.
+    """
+    m = (model.n_thrusters,)
+    return (
+        ('utilization', np.float64, ()),
+        ('feasible', bool, ()),
+        ('thrust', np.float64, m),
+        ('azimuth', np.float64, m),
+        ('thruster_utilization', np.float64, m),
+        )
+
+
+def solve_loads(params, loads):
+    """Solve the allocation of (loads, 3) total loads on the vessel at
+    once (see surrogate.LoadGrid). Return the required utilization and
+    the feasibility of each load.
+    """
+    solution = get_allocator(params).allocate(-np.asarray(loads), utilization_limit(params))
+    return solution['required'], solution['feasible']
+
+
+def thrust_problem(allocator, applied, limit):
+    """Capability problem of the environmental force: return a function
+    building, for given headings [deg] the force comes from, the function
+    tau(scale, index) of the required forces at the (index, k) scales and
+    the upper bounds of the scales.
+    """
+    upper = limit * allocator.max_thrust[allocator.active].sum()
+
+    def build(headings):
+        theta = np.radians(headings)
+        # Thrust required per unit of environmental force
+        direction = np.stack((np.cos(theta), np.sin(theta), np.zeros_like(theta)), 1)
+
+        def tau(scale, index):
+            return scale[:, :, None] * direction[index, None, :] - applied
+
+        return tau, np.full(len(theta), upper)
+
+    return build
+
+
+class EnvironmentLoads(object):
+
+    """Environmental loads of a speed capability problem at given
+    headings [deg]: the fixed part of the environment and the searched
+    part (wind or current) per squared speed. Waves and the other of wind
+    and current come from the same heading, as defined by the parameters.
+    The loads of the last headings are kept.
+    """
+
+    def __init__(self, model, params, searched):
+        self.model = model
+        self.searched = searched
+        self.wave = [_float(params, k) for k in ('wave_hs', 'wave_tp', 'wave_gamma')]
+        self.curr_vel = 0.0 if searched == 'current' else _float(params, 'curr_vel')
+        self.wind_vel = 0.0 if searched == 'wind' else _float(params, 'wind_vel')
+        self._loads = {}
+
+    def __call__(self, headings):
+        headings = np.asarray(headings, dtype=float)
+        key = headings.tobytes()
+        if key not in self._loads:
+            if len(self._loads) >= ENVIRONMENT_CACHE_SIZE:
+                self._loads.clear()
+            fixed = (
+                drift_loads(self.model, *(self.wave + [headings])) +
+                current_load(self.model, self.curr_vel, headings) +
+                wind_load(self.model, self.wind_vel, headings)
+                )
+            unit_load = wind_load if self.searched == 'wind' else current_load
+            self._loads[key] = fixed, unit_load(self.model, 1.0, headings)
+        return self._loads[key]
+
+
+def speed_problem(environment, applied):
+    """Capability problem of the wind or current speed, see
+    thrust_problem(), from the EnvironmentLoads of the headings and the
+    applied load.
+    """
+    def build(headings):
+        fixed, per_speed = environment(headings)
+        fixed = fixed + applied
+
+        def tau(speed, index):
+            return -(
+                fixed[index, None, :] +
+                speed[:, :, None] ** 2 * per_speed[index, None, :]
+                )
+
+        return tau, np.full(len(headings), SPEED_UPPER[environment.searched])
+
+    return build
+
+
+def capability(allocator, problem, headings, limit, tol, expand=False,
+               callback=None, active=None, guess=None):
+    """Solve a capability problem (see thrust_problem()) for each heading
+    [deg]. Return the limits and the (headings, thrusters) saturated
+    thrusters at the limits.
+
+    The searches start around the guess of the limits, if given. Without
+    guess, every SEED_STRIDE-th heading is searched first and the limits
+    of the others are guessed from them by linear interpolation.
+
+    With a (configurations, thrusters) array of the thrusters in
+    operation, every configuration is solved in the same batch and the
+    results have a first dimension over the configurations. The
+    utilization limit may then be given per configuration.
+    """
+    n = len(headings)
+    tau, upper = problem(headings)
+    configurations = (
+        allocator.active[None, :] if active is None else np.asarray(active)
+        )
+    upper = np.tile(upper, len(configurations))
+    limits = np.broadcast_to(np.asarray(limit, dtype=float), (len(configurations),))
+
+    def is_feasible(scale, index):
+        shape = scale.shape
+        scale = scale.reshape(len(index), -1)
+        required = tau(scale, index % n)
+        variant = np.repeat(index // n, scale.shape[1])
+        feasible = allocator.allocate(
+            required.reshape(-1, 3), limits[variant],
+            active=configurations[variant],
+            )['feasible']
+        return feasible.reshape(shape)
+
+    def search(subset, guess, start, share):
+        def subset_feasible(scale, index):
+            return is_feasible(scale, subset[index])
+
+        def subset_callback(fraction):
+            if callback is not None:
+                callback(start + share * fraction)
+
+        return bisect_limit(
+            subset_feasible, upper[subset], tol, expand=expand,
+            callback=subset_callback, guess=guess,
+            )
+
+    values = np.zeros(len(upper))
+    if guess is not None:
+        guess = np.broadcast_to(guess, (len(configurations), n)).ravel()
+        values[:] = search(np.arange(len(upper)), guess, 0.0, 1.0)
+    else:
+        coarse = np.zeros(n, dtype=bool)
+        coarse[::SEED_STRIDE] = True
+        first = np.flatnonzero(np.tile(coarse, len(configurations)))
+        others = np.flatnonzero(~np.tile(coarse, len(configurations)))
+        values[first] = search(first, None, 0.0, 0.5)
+        if len(others):
+            guess = [
+                np.interp(headings[~coarse], headings[coarse], v[coarse], period=360.0)
+                for v in values.reshape(len(configurations), n)
+                ]
+            values[others] = search(others, np.ravel(guess), 0.5, 0.5)
+
+    index = np.arange(len(values))
+    saturated = allocator.allocate(
+        tau(values[:, None], index % n)[:, 0], limits[index // n],
+        active=configurations[index // n],
+        )['saturated']
+
+    if active is None:
+        return values, saturated
+    return (
+        values.reshape(len(configurations), n),
+        saturated.reshape(len(configurations), n, -1),
+        )
+
+
+def adaptive_capability(allocator, problem, limit, tol, expand=False,
+                        stop=360.0, callback=None, active=None):
+    """Solve a capability problem on headings from 0 to stop [deg],
+    refined where the envelope needs it: every interval of a coarse grid
+    is split in two, and the halves are split again while the value at
+    their middle differs from the linear interpolation by more than a
+    fraction of the maximum value, or the saturated thrusters differ from
+    those of its ends. active gives the thrusters in operation, those of
+    the allocator by default. Return the headings and the limits.
+    """
+    if active is not None:
+        active = np.asarray(active)[None, :]
+
+    def solve(headings, callback, guess=None):
+        values, saturated = capability(
+            allocator, problem, headings, limit, tol, expand, callback, active,
+            guess,
+            )
+        if active is None:
+            return values, saturated
+        return values[0], saturated[0]
+
+    rounds = int(np.log2(COARSE_STEP / MIN_STEP)) + 1
+    done = [0]
+
+    def step_callback(fraction):
+        if callback is not None:
+            callback((done[0] + fraction) / rounds)
+
+    # The grid of a whole turn is closed by copying the first heading
+    closed = stop >= 360.0
+    headings = np.arange(0.0, stop + 0.5 * COARSE_STEP, COARSE_STEP)
+    n_solved = len(headings) - 1 if closed else len(headings)
+    values, saturated = solve(headings[:n_solved], step_callback)
+    if closed:
+        values = np.append(values, values[0])
+        saturated = np.append(saturated, saturated[:1], axis=0)
+
+    refine = np.ones(len(headings) - 1, dtype=bool)
+    while True:
+        done[0] += 1
+        refine &= np.diff(headings) >= 2 * MIN_STEP * (1 - 1e-9)
+        if not refine.any():
+            break
+
+        left = np.flatnonzero(refine)
+        middle = 0.5 * (headings[left] + headings[left + 1])
+        # The limits of the ends seed the searches
+        v, s = solve(
+            middle, step_callback, 0.5 * (values[left] + values[left + 1])
+            )
+
+        error = np.abs(v - 0.5 * (values[left] + values[left + 1]))
+        split = (
+            (error > REFINE_TOL * np.max(values)) |
+            np.any(s != saturated[left], axis=1) |
+            np.any(s != saturated[left + 1], axis=1)
+            )
+
+        headings = np.insert(headings, left + 1, middle)
+        values = np.insert(values, left + 1, v)
+        saturated = np.insert(saturated, left + 1, s, axis=0)
+
+        # Both halves of the split intervals
+        refine = np.zeros(len(headings) - 1, dtype=bool)
+        first = left + np.arange(len(left))
+        refine[first[split]] = True
+        refine[first[split] + 1] = True
+
+    if closed:
+        return headings[:-1], values[:-1]
+    return headings, values
+
+
+def capability_cases(params, model, allocator):
+    """Labels, thrusters in operation and utilization limits of the
+    envelopes of a capability plot: every failure case for every limit.
+    """
+    limits = utilization_limits(params)
+    cases = failure_cases(params, model, allocator)
+    labels = []
+    configurations = []
+    limit = []
+    for l in limits:
+        for label, active in cases:
+            if len(limits) > 1:
+                label = '%s %g%%' % (label, 100 * l)
+            labels.append(label)
+            configurations.append(active)
+            limit.append(l)
+    return labels, np.array(configurations), np.array(limit)
+
+
+def _vessel_signature(params):
+    fname = params.get('vessel')
+    return fname, os.path.getmtime(fname)
+
+
+def _capability_problem(params, allocator, environment, cases):
+    """Problem builder, tolerance, whether the bounds are expanded and
+    unit of a capability plot.
+    """
+    applied = applied_load(params)
+    if environment is None:
+        labels, configurations, limit = cases
+        problem = thrust_problem(allocator, applied, np.max(limit))
+        return problem, FORCE_TOL, False, 'kN'
+    return speed_problem(environment, applied), SPEED_TOL, True, 'm/s'
+
+
+def capability_graph():
+    """EvaluationGraph of the stages of the capability plots, from the
+    vessel model to the capability problem. Keeping the graph between two
+    runs only recomputes the stages depending on the changed parameters:
+    a new utilization limit does not compute the environmental loads
+    again.
+    """
+    graph = EvaluationGraph()
+    graph.add(
+        'model', (), (), lambda p: load_vessel(p['vessel']),
+        signature=_vessel_signature,
+        )
+    graph.add(
+        'allocator', ('failed_thrusters',), ('model',),
+        lambda p, model: get_allocator(p),
+        )
+    graph.add(
+        'cases', ('failure_depth', 'use_limitation'), ('model', 'allocator'),
+        capability_cases,
+        )
+    graph.add(
+        'environment',
+        ('simulation', 'wave_hs', 'wave_tp', 'wave_gamma', 'curr_vel', 'wind_vel'),
+        ('model',),
+        lambda p, model: (
+            EnvironmentLoads(model, p, SPEED_SEARCHES[p['simulation']])
+            if p.get('simulation') in SPEED_SEARCHES else None
+            ),
+        )
+    graph.add(
+        'problem', ('simulation', 'load_x', 'load_y', 'load_z'),
+        ('allocator', 'environment', 'cases'),
+        _capability_problem,
+        )
+    return graph
+
+
+def run_simulation(params, messages, control, graph=None):
+    """Job of the capability plot form. Progress, status and partial
+    results are reported through the messages queue (see engine.Worker)
+    and control.checkpoint() is called between two steps. graph is the
+    capability_graph() of the previous runs, if any.
+    """
+    simulation = params.get('simulation')
+    if (simulation != 'Thrust Capability Plot' and
+            simulation not in SPEED_SEARCHES):
+        raise NotImplementedError('%s is not available' % simulation)
+
+    # The stages unchanged since the previous run of the graph are reused
+    graph = graph if graph is not None else capability_graph()
+    model, allocator, cases, problem = graph.evaluate(
+        params, 'model', 'allocator', 'cases', 'problem'
+        )
+    labels, configurations, limit = cases
+    problem, tol, expand, unit = problem
+    headings = np.arange(0.0, 360.0, HEADING_STEP)
+
+    def callback(fraction):
+        messages.put(('progress', fraction))
+        control.checkpoint()
+
+    symmetric = params.get('symmetrize') and symmetric_problem(
+        params, model, allocator, configurations
+        )
+
+    def send(k, headings, values):
+        messages.put(('result', {
+            'label': labels[k] if len(labels) > 1 else simulation,
+            'headings': headings,
+            'values': values,
+            'unit': unit,
+            }))
+
+    # Each envelope is sent as soon as it is finished, so a stopped run
+    # keeps the envelopes solved before the stop
+    messages.put(('status', simulation))
+    if params.get('adaptive'):
+        # Each configuration has its own headings
+        for k, active in enumerate(configurations):
+            def case_callback(fraction, k=k):
+                callback((k + fraction) / len(configurations))
+            headings, values = adaptive_capability(
+                allocator, problem, limit[k], tol, expand,
+                180.0 if symmetric else 360.0, case_callback, active,
+                )
+            if symmetric:
+                headings = np.append(headings, 360.0 - headings[-2:0:-1])
+                values = np.append(values, values[-2:0:-1])
+            send(k, headings, values)
+    else:
+        # Headings from 180 to 360 deg are the mirror images of the others
+        computed, mirror = headings, slice(None)
+        if symmetric:
+            folded = np.where(headings > 180.0, 360.0 - headings, headings)
+            computed, mirror = np.unique(folded, return_inverse=True)
+
+        # The configurations are solved by batches sharing the bisection
+        for first in range(0, len(configurations), CONFIGURATION_BATCH):
+            batch = slice(first, first + CONFIGURATION_BATCH)
+            def batch_callback(fraction, first=first):
+                callback(
+                    (first + fraction * len(configurations[batch])) /
+                    len(configurations)
+                    )
+            values = capability(
+                allocator, problem, computed, limit[batch], tol, expand,
+                batch_callback, configurations[batch],
+                )[0][:, mirror]
+            for k, v in enumerate(values):
+                send(first + k, headings, v)
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*
+"""
+    Surrogate of the batch cases.
+
+    The allocation of a case only depends on the total load (Fx, Fy, Mz)
+    on the vessel. The utilization is solved on a regular grid over the
+    range of the loads of the batch, then interpolated for each case.
+    Cases close to the utilization limit, or whose grid cell straddles the
+    limit, are better solved exactly.
+
+    This module does not depend on Qt so that the grid can be solved by
+    the worker processes.
+"""
+import numpy as np
+
+
+# Cases whose interpolated utilization is closer to the limit than this
+# margin are solved exactly
+SURROGATE_MARGIN = 0.05
+
+# Grid nodes solved at once
+BLOCK_SIZE = 4096
+
+
+class LoadGrid(object):
+
+    """Regular grid over the range of (loads, 3) total loads. Components
+    which do not vary have a single node.
+    """
+
+    def __init__(self, loads, points):
+        loads = np.asarray(loads, dtype=float)
+        low, high = loads.min(axis=0), loads.max(axis=0)
+        self.axes = [
+            np.linspace(l, h, points) if h > l else np.array([l])
+            for l, h in zip(low, high)
+            ]
+
+    @property
+    def shape(self):
+        return tuple(len(axis) for axis in self.axes)
+
+    def nodes(self):
+        """(nodes, 3) loads of the grid nodes, in C order of the grid"""
+        grids = np.meshgrid(*self.axes, indexing='ij')
+        return np.stack([g.ravel() for g in grids], axis=1)
+
+    def blocks(self):
+        """Grid nodes split into blocks solved by the worker processes"""
+        nodes = self.nodes()
+        return [
+            nodes[start:start + BLOCK_SIZE]
+            for start in range(0, len(nodes), BLOCK_SIZE)
+            ]
+
+    def interpolate(self, values, loads):
+        """Multilinear interpolation at (loads, 3) loads of the values at
+        the grid nodes (an array of the grid shape, or flat in C order).
+        """
+        values = np.asarray(values).reshape(self.shape)
+        loads = np.atleast_2d(loads)
+
+        # Lower node and fraction of the cell along each axis
+        lower, fractions = [], []
+        for axis, x in zip(self.axes, loads.T):
+            if len(axis) == 1:
+                lower.append(np.zeros(len(x), dtype=int))
+                fractions.append(np.zeros(len(x)))
+                continue
+            i = np.clip(np.searchsorted(axis, x, side='right') - 1, 0, len(axis) - 2)
+            lower.append(i)
+            fractions.append(np.clip((x - axis[i]) / (axis[i + 1] - axis[i]), 0.0, 1.0))
+
+        result = np.zeros(len(loads))
+        for corner in np.ndindex(*(min(n, 2) for n in self.shape)):
+            weight = np.ones(len(loads))
+            index = []
+            for c, i, t in zip(corner, lower, fractions):
+                weight *= t if c else 1.0 - t
+                index.append(i + c)
+            result += weight * values[tuple(index)]
+        return result
+
+
+def surrogate_results(grid, required, feasible, loads, limit, resolve=True):
+    """Interpolate the utilization of cases of (loads, 3) loads from the
+    required utilization and feasibility of the grid nodes. Return the
+    dictionnary of the arrays of the fields of the results of the cases,
+    as solve_case() without the thruster details, and the boolean array
+    of the cases to solve exactly (none unless resolve).
+    """
+    utilization = grid.interpolate(required, loads)
+    # A fraction of feasible corners strictly between 0 and 1 shows a
+    # cell across the limit
+    share = grid.interpolate(np.asarray(feasible, dtype=float), loads)
+
+    exact = np.zeros(len(loads), dtype=bool)
+    if resolve:
+        exact = (
+            (np.abs(utilization - limit) < SURROGATE_MARGIN) |
+            ((share > 1e-9) & (share < 1 - 1e-9))
+            )
+
+    fields = {
+        'utilization': utilization,
+        'feasible': utilization <= limit,
+        'surrogate': True,
+        }
+    return fields, exact
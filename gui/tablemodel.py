@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*
+import numpy as np
+
+# GUI module
+from PyQt4 import QtCore, QtGui
+
+
+class ArrayTableModel(QtCore.QAbstractTableModel):
+
+    """Table model storing its values in a contiguous float64 array. Empty
+    cells are NaN values. Text which cannot be converted to a number is
+    kept aside in a sparse dictionnary so it can be displayed and reported
+    without breaking the array storage.
+    """
+
+    def __init__(self, column_headers, nrows=0, parent=None):
+        super(ArrayTableModel, self).__init__(parent)
+
+        self.column_headers = tuple(column_headers)
+        self._data = np.full((nrows, len(self.column_headers)), np.nan)
+        self._invalid = {}
+
+    @property
+    def values(self):
+        """Underlying (rows, columns) array. Must not be resized in place"""
+        return self._data
+
+    @property
+    def invalid_cells(self):
+        """Sorted (row, column) positions of the cells which are not numbers"""
+        return sorted(self._invalid)
+
+    def get_arrays(self, copy=True):
+        """Return a copy of the table values as a (rows, columns) float
+        array, the boolean mask of the cells holding a number and the
+        sorted (row, column) positions of the cells which failed parsing.
+        With copy=False the values are the storage itself, which avoids
+        reading memory-mapped tables into memory.
+        """
+        values = self._data.copy() if copy else self._data
+        return values, ~np.isnan(values), self.invalid_cells
+
+    def set_array(self, array):
+        """Replace the whole content of the table by a (rows, columns)
+        array, which may be memory-mapped. Rows are only read when they
+        are displayed.
+        """
+        if array.ndim != 2 or array.shape[1] != len(self.column_headers):
+            raise ValueError(
+                'Expected an array with %i columns' % len(self.column_headers)
+                )
+        self.beginResetModel()
+        self._data = array
+        self._invalid = {}
+        self.endResetModel()
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self._data.shape[0]
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self._data.shape[1]
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if role != QtCore.Qt.DisplayRole:
+            return None
+        if orientation == QtCore.Qt.Horizontal:
+            return self.column_headers[section]
+        return str(section + 1)
+
+    def flags(self, index):
+        return (
+            QtCore.Qt.ItemIsEnabled |
+            QtCore.Qt.ItemIsSelectable |
+            QtCore.Qt.ItemIsEditable
+            )
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+
+        row, col = index.row(), index.column()
+
+        if role in (QtCore.Qt.DisplayRole, QtCore.Qt.EditRole):
+            if (row, col) in self._invalid:
+                return self._invalid[(row, col)]
+            value = self._data[row, col]
+            if np.isnan(value):
+                return ''
+            return repr(float(value))
+
+        # Highlight the cells which are not numbers
+        if role == QtCore.Qt.BackgroundRole and (row, col) in self._invalid:
+            return QtGui.QBrush(QtGui.QColor('indianred'))
+
+        return None
+
+    def setData(self, index, value, role=QtCore.Qt.EditRole):
+        if not index.isValid() or role != QtCore.Qt.EditRole:
+            return False
+
+        row, col = index.row(), index.column()
+        text = str(value).strip()
+        self._invalid.pop((row, col), None)
+
+        if not text:
+            self._data[row, col] = np.nan
+        else:
+            try:
+                self._data[row, col] = float(text)
+            except ValueError:
+                self._data[row, col] = np.nan
+                self._invalid[(row, col)] = text
+
+        self.dataChanged.emit(index, index)
+        return True
+
+    def _drop_invalid(self, first_row, first_col, last_row, last_col):
+        for key in list(self._invalid):
+            if (first_row <= key[0] <= last_row and
+                    first_col <= key[1] <= last_col):
+                del self._invalid[key]
+
+    def clear(self, first_row, first_col, last_row, last_col):
+        """Empty a rectangular block of cells (bounds included)"""
+
+        self._data[first_row:last_row + 1, first_col:last_col + 1] = np.nan
+        self._drop_invalid(first_row, first_col, last_row, last_col)
+
+        self.dataChanged.emit(
+            self.index(first_row, first_col), self.index(last_row, last_col)
+            )
+
+    def set_block(self, first_row, first_col, block, invalid=None):
+        """Write a 2-D block of values with its upper left corner at the
+        given cell, as a single model update. Rows are appended if the
+        block overflows the table, extra columns are dropped.
+        """
+
+        nrows, ncols = block.shape
+        ncols = min(ncols, self._data.shape[1] - first_col)
+        if nrows == 0 or ncols <= 0:
+            return
+
+        last_row = first_row + nrows - 1
+        last_col = first_col + ncols - 1
+        if last_row >= self._data.shape[0]:
+            self.resize(last_row + 1)
+            # Memory-mapped tables do not grow, the block is cut
+            last_row = min(last_row, self._data.shape[0] - 1)
+            nrows = last_row - first_row + 1
+
+        self._data[first_row:last_row + 1, first_col:last_col + 1] = block[:nrows, :ncols]
+        self._drop_invalid(first_row, first_col, last_row, last_col)
+        for (r, c), text in (invalid or {}).items():
+            if r < nrows and c < ncols:
+                self._invalid[(first_row + r, first_col + c)] = text
+
+        self.dataChanged.emit(
+            self.index(first_row, first_col), self.index(last_row, last_col)
+            )
+
+    def resize(self, nrows):
+        """Append or remove rows at the end of the table. A memory-mapped
+        table, as imported from a sea states file, is only shortened, by
+        a view of its first rows: appending rows would read the whole
+        file into memory.
+        """
+
+        current = self._data.shape[0]
+        if nrows == current:
+            return
+
+        mapped = isinstance(self._data, np.memmap)
+        if nrows > current and mapped:
+            # Views of the model (row count spinbox) go back to the
+            # current size
+            self.beginResetModel()
+            self.endResetModel()
+
+        elif nrows > current:
+            self.beginInsertRows(QtCore.QModelIndex(), current, nrows - 1)
+            extra = np.full((nrows - current, self._data.shape[1]), np.nan)
+            self._data = np.concatenate((self._data, extra))
+            self.endInsertRows()
+
+        else:
+            self.beginRemoveRows(QtCore.QModelIndex(), nrows, current - 1)
+            self._data = self._data[:nrows] if mapped else self._data[:nrows].copy()
+            for key in list(self._invalid):
+                if key[0] >= nrows:
+                    del self._invalid[key]
+            self.endRemoveRows()
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*
+"""
+    Vessel model loading.
+
+    A vessel model is described by a YAML file:
+
+        name: Pipelay vessel
+        thrusters:
+          - name: T1
+            x: -60.0            # [m] positive to the bow
+            y: 8.0              # [m] positive to portside
+            type: azimuth       # azimuth or fixed
+            angle: 0.0          # [deg] direction of a fixed thruster
+            max_thrust: 600.0   # [kN]
+        wind:
+          headings: [0, 30, ..., 180]   # [deg] relative heading
+          cx: [...]                     # [kN/(m/s)^2]
+          cy: [...]                     # [kN/(m/s)^2]
+          cz: [...]                     # [kN.m/(m/s)^2]
+        current:
+          (same as wind)
+        drift:
+          headings: [0, 30, ..., 180]   # [deg] relative heading
+          periods: [4, 5, ..., 20]      # [s] wave period
+          cx: [[...], ...]              # [kN/m^2] one row per heading
+          cy: [[...], ...]              # [kN/m^2]
+          cz: [[...], ...]              # [kN.m/m^2]
+
+    Headings are measured from the bow, positive to portside. The YAML
+    file is compiled once into a directory of .npy files stored next to
+    it, which is then memory-mapped: every process using the model shares
+    the same read-only pages. A modified file is compiled into a new
+    directory.
+"""
+import os
+import json
+import shutil
+import hashlib
+
+import numpy as np
+import yaml
+
+# Project modules
+from environment import HeadingTable
+
+
+# Thruster types
+AZIMUTH, FIXED = 0, 1
+
+# Version of the compiled format, changing it invalidates every compiled
+# model
+COMPILED_VERSION = 2
+
+# Coefficients tables
+LOAD_TABLES = ('wind', 'current')
+COMPONENTS = ('cx', 'cy', 'cz')
+
+# Models loaded by the current process
+_models = {}
+
+
+class VesselError(ValueError):
+    """Raised when a vessel model file cannot be understood"""
+
+
+def _file_sha1(fname):
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        h.update(f.read())
+    return h.hexdigest()
+
+
+def compiled_path(fname):
+    return os.path.abspath(fname) + '.compiled'
+
+
+def _compile(data):
+    """Convert the YAML content of a vessel model into a dictionnary of
+    arrays.
+    """
+    thrusters = data.get('thrusters') or []
+    if not thrusters:
+        raise ValueError('Vessel model without thrusters')
+
+    arrays = {
+        'thruster_names': np.array(
+            [str(t.get('name', 'T%i' % (i + 1))) for i, t in enumerate(thrusters)]
+            ),
+        'thruster_x': np.array([float(t['x']) for t in thrusters]),
+        'thruster_y': np.array([float(t['y']) for t in thrusters]),
+        'thruster_type': np.array(
+            [FIXED if t.get('type') == 'fixed' else AZIMUTH for t in thrusters]
+            ),
+        'thruster_angle': np.radians(
+            [float(t.get('angle', 0.0)) for t in thrusters]
+            ),
+        'thruster_max': np.array([float(t['max_thrust']) for t in thrusters]),
+        }
+
+    for table in LOAD_TABLES:
+        coefs = data.get(table) or {}
+        headings = np.asarray(coefs.get('headings', [0.0]), dtype=float)
+        arrays[table + '_headings'] = np.radians(headings)
+        arrays[table + '_coefs'] = np.array([
+            np.broadcast_to(
+                np.asarray(coefs.get(c, 0.0), dtype=float), headings.shape
+                )
+            for c in COMPONENTS
+            ])
+
+    drift = data.get('drift') or {}
+    headings = np.asarray(drift.get('headings', [0.0]), dtype=float)
+    periods = np.asarray(drift.get('periods', [1.0]), dtype=float)
+    arrays['drift_headings'] = np.radians(headings)
+    arrays['drift_periods'] = periods
+    arrays['drift_coefs'] = np.array([
+        np.broadcast_to(
+            np.asarray(drift.get(c, 0.0), dtype=float),
+            (len(headings), len(periods)),
+            )
+        for c in COMPONENTS
+        ])
+
+    return arrays
+
+
+def _write_meta(fname, meta):
+    """Write a meta file through a temporary file, so it is always
+    complete.
+    """
+    with open(fname + '.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(fname + '.tmp', fname)
+
+
+def compile_vessel(fname):
+    """Compile a YAML vessel model next to it, unless the compiled model
+    is up to date. Return the path of the compiled model.
+
+    Each content of the YAML file is compiled into its own directory,
+    named by its hash, and the meta file of the compiled path points to
+    the current one. The files of the previous contents are never
+    rewritten: models loaded before may still have them memory-mapped.
+    """
+    root = compiled_path(fname)
+    meta_path = os.path.join(root, 'meta.json')
+    mtime = os.path.getmtime(fname)
+
+    meta = {}
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        if (meta.get('version') == COMPILED_VERSION and
+                meta.get('mtime') == mtime):
+            return os.path.join(root, meta['sha1'])
+
+    # Touched but maybe not modified, or back to a compiled content
+    sha1 = _file_sha1(fname)
+    path = os.path.join(root, sha1)
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        try:
+            with open(fname, 'r') as f:
+                data = yaml.safe_load(f)
+            arrays = _compile(data)
+        except (yaml.YAMLError, KeyError, TypeError, AttributeError, ValueError) as e:
+            raise VesselError('Invalid vessel model %s: %s' % (fname, e))
+
+        # Left by an interrupted compilation, never loaded
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        for name, array in arrays.items():
+            np.save(os.path.join(path, name + '.npy'), array)
+
+        # The meta file is written last: it validates the compiled model
+        _write_meta(os.path.join(path, 'meta.json'), {
+            'name': str(data.get('name', os.path.basename(fname))),
+            'sha1': sha1,
+            })
+
+    _write_meta(meta_path, {
+        'version': COMPILED_VERSION, 'mtime': mtime, 'sha1': sha1,
+        })
+    return path
+
+
+class VesselModel(object):
+
+    """Vessel model made of read-only arrays memory-mapped from a
+    compiled model.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        self.name = meta['name']
+        self.sha1 = meta['sha1']
+
+        for name in os.listdir(path):
+            if name.endswith('.npy'):
+                setattr(
+                    self, name[:-4],
+                    np.load(os.path.join(path, name), mmap_mode='r'),
+                    )
+
+        # Interpolants of the load tables
+        self.wind_table = HeadingTable(self.wind_headings, self.wind_coefs)
+        self.current_table = HeadingTable(self.current_headings, self.current_coefs)
+
+    @property
+    def n_thrusters(self):
+        return len(self.thruster_max)
+
+    def thruster_index(self, name):
+        """Index of a thruster from its name"""
+        names = self.thruster_names.tolist()
+        if name not in names:
+            raise KeyError('Unknown thruster: %s' % name)
+        return names.index(name)
+
+
+def load_vessel(fname):
+    """Return the vessel model of a YAML file. The model is compiled if
+    necessary and kept in memory for the next calls of the process.
+    """
+    key = os.path.abspath(fname)
+    mtime = os.path.getmtime(fname)
+
+    cached = _models.get(key)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    # The previous model is released before the new one is compiled
+    _models.pop(key, None)
+    model = VesselModel(compile_vessel(fname))
+    _models[key] = (mtime, model)
+    return model
@@ -12,17 +12,30 @@ class BaseWidget(QWidget):
     def __init__(self, parent=None, **kwargs):
         super(BaseWidget, self).__init__(parent)
 
+        # Object running the current job. It must provide pause(),
+        # resume(), stop() and the paused property (see engine.Worker and
+        # engine.BatchRunner)
+        self.job = None
+
     def run(self):
         raise NotImplementedError()
 
     def pause(self):
-        raise NotImplemented()
+        """Pause the running job, or resume it if it is already paused"""
+        if self.job is None:
+            return
+        if self.job.paused:
+            self.job.resume()
+        else:
+            self.job.pause()
 
     def stop(self):
-        raise NotImplemented()
+        """Stop the running job. Results already computed are kept"""
+        if self.job is not None:
+            self.job.stop()
 
     def export(self, *args, **kwargs):
-        raise NotImplemented()
+        raise NotImplementedError()
 
     def communicate(self, *args, **kwargs):
         raise NotImplementedError()